@@ -0,0 +1,353 @@
+"""
+Offline benchmarks for the BanSync cog.
+
+Runs the cog against a fake bot whose guilds answer bans() (paged like
+discord.py 2), ban() and unban() with a configurable latency, jitter, 429 rate
+and Forbidden rate, so sync performance can be measured without touching real servers.
+
+For every scale (guild count x ban count) it measures bansync_root, globalban,
+globalunban, tempban expiry, importing ban_count new bans and adding one new
+guild with sync, and prints the wall time, the number of API calls made and the peak memory.
+
+Usage: python benchmarks/bench_globalban.py --guilds 10,100 --bans 1000,10000
+"""
+import argparse
+import asyncio
+from collections import Counter
+import contextlib
+import heapq
+import json
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import discord
+
+import globalban.globalban as cog_module
+from globalban.records import FOREVER_BANTIME, GlobalBan
+from globalban.transfer import write_bans
+
+
+class FakeResponse:
+    def __init__(self, status, reason, headers=None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+
+
+class FakeValue:
+    """
+    Stands in for a Red Config value: it can be awaited, used with async with and set.
+    """
+
+    def __init__(self, config, name):
+        self.config = config
+        self.name = name
+
+    def __call__(self):
+        return self
+
+    def __await__(self):
+        async def get():
+            return self.config.data.get(self.name, self.config.defaults.get(self.name))
+        return get().__await__()
+
+    async def __aenter__(self):
+        if self.name not in self.config.data:
+            self.config.data[self.name] = json.loads(json.dumps(self.config.defaults.get(self.name)))
+        return self.config.data[self.name]
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def set(self, value):
+        self.config.data[self.name] = value
+
+
+class FakeConfig:
+    def __init__(self):
+        self.data = {}
+        self.defaults = {}
+
+    def register_global(self, **defaults):
+        self.defaults.update(defaults)
+
+    def __getattr__(self, name):
+        return FakeValue(self, name)
+
+
+class FakeGuild:
+    """
+    A guild that answers ban calls after a random delay and sometimes fails.
+    """
+
+    def __init__(self, bot, id, banned, forbidden=False):
+        self.bot = bot
+        self.id = id
+        self.name = 'Guild {}'.format(id)
+        self.banned = set(banned)
+        self.forbidden = forbidden
+
+    async def _request(self, kind):
+        options = self.bot.options
+        self.bot.calls[kind] += 1
+        await asyncio.sleep(max(0.0, options.latency + random.uniform(-options.jitter, options.jitter)))
+        if self.forbidden:
+            self.bot.calls['forbidden'] += 1
+            raise discord.errors.Forbidden(FakeResponse(403, 'Forbidden'), 'Missing Permissions')
+        if random.random() < options.ratelimit:
+            self.bot.calls['429'] += 1
+            headers = {'Retry-After': str(options.retry_after), 'X-RateLimit-Global': 'false'}
+            raise discord.errors.HTTPException(FakeResponse(429, 'Too Many Requests', headers), 'You are being rate limited.')
+
+    def bans(self, limit=1000, after=None):
+        """
+        Gives the bans like discord.py 2: an async iterator of up to limit bans with a user ID above after.
+        """
+        return self._ban_page(limit, 0 if after is None else after.id)
+
+    async def _ban_page(self, limit, after):
+        await self._request('bans')
+        for id in heapq.nsmallest(limit, (id for id in self.banned if id > after)):
+            yield SimpleNamespace(user=SimpleNamespace(id=id), reason=None)
+
+    async def ban(self, user, delete_message_days=1, reason=None):
+        await self._request('ban')
+        self.banned.add(user.id)
+
+    async def unban(self, user, reason=None):
+        await self._request('unban')
+        if user.id not in self.banned:
+            raise discord.errors.NotFound(FakeResponse(404, 'Not Found'), 'Unknown Ban')
+        self.banned.discard(user.id)
+
+
+class FakeMember:
+    def __init__(self, id):
+        self.id = id
+        self.name = 'User {}'.format(id)
+
+    async def send(self, message):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+
+    async def edit(self, content):
+        self.content = content
+
+
+class FakeContext:
+    prefix = '[p]'
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(FakeMessage(message))
+        return self.sent[-1]
+
+
+class FakeBot:
+    """
+    Just enough of a Red bot for BanSync.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.loop = asyncio.get_event_loop()
+        self.calls = Counter()
+        self._guilds = {}
+        owner = FakeMember(0)
+        self._app_info = SimpleNamespace(owner=owner)
+
+    @property
+    def guilds(self):
+        return list(self._guilds.values())
+
+    def add_guild(self, guild):
+        self._guilds[guild.id] = guild
+
+    def get_guild(self, id):
+        return self._guilds.get(id)
+
+    def get_channel(self, id):
+        return FakeContext()
+
+    async def wait_until_ready(self):
+        pass
+
+    async def application_info(self):
+        return self._app_info
+
+
+async def make_cog(options, guild_count, ban_count, data_path):
+    """
+    Builds a BanSync cog on a fake bot with guild_count guilds and ban_count global bans.
+    Every guild already has options.prebanned of the global bans.
+    """
+    cog_module.Config = SimpleNamespace(get_conf=lambda cog, identifier: FakeConfig())
+    cog_module.cog_data_path = lambda cog: pathlib.Path(data_path)
+    cog_module.OUTBOX_BACKOFF = options.outbox_backoff
+    bot = FakeBot(options)
+    ids = list(range(10 ** 17, 10 ** 17 + ban_count))
+    for number in range(guild_count):
+        banned = random.sample(ids, int(len(ids) * options.prebanned))
+        bot.add_guild(FakeGuild(bot, 1000 + number, banned, forbidden=random.random() < options.forbidden))
+
+    cog = cog_module.BanSync(bot)
+    cog.task.cancel()
+    cog.ratelimiter.per_second = options.rate
+    cog.ratelimiter.retries = options.retries
+    await cog.config.synced_servers.set([guild.id for guild in bot.guilds])
+    await cog.initiate
+    for id in ids:
+        cog.put_ban(GlobalBan(id, 'User {}'.format(id), 'Benchmark', FOREVER_BANTIME, None))
+    await cog.flush()
+    bot.calls.clear()
+    return bot, cog
+
+
+async def measure(name, bot, coroutine):
+    """
+    Runs one benchmark and gives its wall time, API calls and peak memory.
+    """
+    bot.calls.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            await coroutine
+        except Exception as ex:
+            error = '{}: {}'.format(type(ex).__name__, ex)
+    wall = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'benchmark': name, 'wall': wall, 'calls': dict(bot.calls), 'peak_kib': peak / 1024, 'error': error}
+
+
+async def drain_outbox(cog):
+    """
+    Waits until every ban and unban in the outbox has been applied.
+    """
+    while await cog.store.next_due() is not None:
+        await asyncio.sleep(0.01)
+
+
+async def run_command(cog, command, *args, **kwargs):
+    """
+    Runs a command and waits until the outbox has applied what it queued.
+    """
+    await command.callback(cog, *args, **kwargs)
+    await drain_outbox(cog)
+
+
+async def expire_tempbans(cog, count):
+    """
+    Turns count global bans into tempbans that have just run out and waits for them to be lifted.
+    """
+    ids = list(cog.bans)[:count]
+    now = time.time()
+    for id in ids:
+        ban = cog.bans[id]
+        cog.put_ban(GlobalBan(id, ban.name, ban.reason, now, 60))
+        cog.schedule_expiry(id, now)
+    while any(id in cog.bans for id in ids) or await cog.store.next_due() is None:
+        await asyncio.sleep(0.01)
+    await drain_outbox(cog)
+
+
+async def import_bans(cog, data_path, count):
+    """
+    Imports count new global bans from a JSON lines file and waits until they are applied everywhere.
+    """
+    path = pathlib.Path(data_path) / 'bench_import.jsonl'
+    first = 2 * 10 ** 17
+    with open(str(path), 'w') as file:
+        write_bans((GlobalBan(id, 'User {}'.format(id), 'Imported', FOREVER_BANTIME, None) for id in range(first, first + count)), file, 'jsonl')
+    await cog.import_bans(path, 'jsonl')
+    await drain_outbox(cog)
+
+
+async def run_scale(options, guild_count, ban_count):
+    results = []
+    with tempfile.TemporaryDirectory() as data_path:
+        bot, cog = await make_cog(options, guild_count, ban_count, data_path)
+        ctx = FakeContext()
+        results.append(await measure('bansync_root', bot, cog.bansync_root(full=True)))
+        results.append(await measure('bansync_root (incremental)', bot, cog.bansync_root()))
+        member = FakeMember(1)
+        results.append(await measure('globalban', bot, run_command(cog, cog_module.BanSync.globalban, ctx, member, 'Benchmark', '/')))
+        await cog.flush()
+        results.append(await measure('globalunban', bot, run_command(cog, cog_module.BanSync.globalunban, ctx, id=str(member.id))))
+        results.append(await measure('tempban expiry', bot, expire_tempbans(cog, min(ban_count, options.tempbans))))
+        results.append(await measure('importbans', bot, import_bans(cog, data_path, ban_count)))
+        server = FakeGuild(bot, 1000 + guild_count, random.sample(list(cog.bans), int(len(cog.bans) * options.prebanned)))
+        bot.add_guild(server)
+        results.append(await measure('sync (one new guild)', bot, cog_module.BanSync.sync.callback(cog, ctx, id=str(server.id))))
+        cog.tempbans.cancel()
+        cog.outbox.cancel()
+        cog.coordination.cancel()
+        await cog.close_store()
+    for result in results:
+        result.update({'guilds': guild_count, 'bans': ban_count})
+    return results
+
+
+def print_results(results):
+    print('{:<28} {:>7} {:>8} {:>10} {:>12}  {}'.format('benchmark', 'guilds', 'bans', 'wall (s)', 'peak (KiB)', 'API calls'))
+    for result in results:
+        calls = ', '.join('{}={}'.format(kind, count) for kind, count in sorted(result['calls'].items()))
+        if result['error'] is not None:
+            calls += ' (failed: {})'.format(result['error'])
+        print('{:<28} {:>7} {:>8} {:>10.3f} {:>12.1f}  {}'.format(
+            result['benchmark'], result['guilds'], result['bans'], result['wall'], result['peak_kib'], calls or '-'
+        ))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--guilds', default='5,50', help='Comma separated guild counts.')
+    parser.add_argument('--bans', default='100,1000', help='Comma separated global ban counts.')
+    parser.add_argument('--latency', type=float, default=0.001, help='Seconds every fake API call takes.')
+    parser.add_argument('--jitter', type=float, default=0.0005, help='Random +/- seconds added to the latency.')
+    parser.add_argument('--ratelimit', type=float, default=0.0, help='Chance that a call is answered with a 429.')
+    parser.add_argument('--retry-after', type=float, default=0.05, help='Retry-After seconds sent with a 429.')
+    parser.add_argument('--retries', type=int, default=5, help='How many times the cog retries a 429.')
+    parser.add_argument('--outbox-backoff', type=float, default=0.01, help='Seconds the first outbox retry waits.')
+    parser.add_argument('--forbidden', type=float, default=0.0, help='Chance that a guild answers with Forbidden.')
+    parser.add_argument('--prebanned', type=float, default=0.9, help='Share of the global bans every guild already has.')
+    parser.add_argument('--rate', type=float, default=1000000, help='Requests per second the cog allows itself.')
+    parser.add_argument('--tempbans', type=int, default=100, help='How many tempbans expire in the expiry benchmark.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Also write the results as JSON to this file.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    random.seed(options.seed)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = []
+    for guild_count in [int(value) for value in options.guilds.split(',')]:
+        for ban_count in [int(value) for value in options.bans.split(',')]:
+            results.extend(loop.run_until_complete(run_scale(options, guild_count, ban_count)))
+    print_results(results)
+    if options.json:
+        with open(options.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+from array import array
+import asyncio
+from bisect import bisect_left
+import time
+
+
+class BanIds:
+    """
+    The IDs banned on one server, kept sorted in an array of 64-bit integers.
+
+    That is 8 bytes per ID instead of the 60 to 90 an int in a set takes, so the ban lists
+    of big servers can stay cached. Lookups use bisect.
+
+    Usage: ids = BanIds(); ids.update(page); if user_id in ids: ...
+    """
+
+    __slots__ = ('_ids',)
+
+    def __init__(self, ids=()):
+        self._ids = array('Q')
+        self.update(ids)
+
+    def __contains__(self, user_id):
+        index = bisect_left(self._ids, user_id)
+        return index < len(self._ids) and self._ids[index] == user_id
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def add(self, user_id):
+        index = bisect_left(self._ids, user_id)
+        if index == len(self._ids) or self._ids[index] != user_id:
+            self._ids.insert(index, user_id)
+
+    def discard(self, user_id):
+        index = bisect_left(self._ids, user_id)
+        if index < len(self._ids) and self._ids[index] == user_id:
+            del self._ids[index]
+
+    def update(self, user_ids):
+        """
+        Adds many IDs. IDs above the highest one so far, like the next page of a
+        ban list ordered by user ID, are simply appended.
+        """
+        for user_id in sorted(user_ids):
+            if len(self._ids) == 0 or user_id > self._ids[-1]:
+                self._ids.append(user_id)
+            else:
+                self.add(user_id)
+
+
+class BanCache:
+    """
+    Keeps the IDs banned on each server in memory.
+
+    A server's ban list is fetched once, then kept up to date by the cog's
+    ban/unban listeners. After ttl seconds it is fetched again in case an event was missed.
+
+    Usage: if user_id in await cache.get(guild, fetch): ...
+    """
+
+    def __init__(self, ttl=6 * 60 * 60):
+        """
+        Input: Seconds before a server's ban list is fetched again
+        Output: Nothing
+        """
+        self.ttl = ttl
+        self._bans = {}
+        self._fetched = {}
+        self._locks = {}
+
+    async def get(self, guild, fetch, refresh=False):
+        """
+        Gives the set of IDs banned on a server, fetching it if it is not cached or too old.
+
+        Input: Server, a coroutine function that fetches the server's banned IDs as BanIds and whether to force a fetch
+        Output: BanIds
+        """
+        lock = self._locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:
+            fetched = self._fetched.get(guild.id)
+            if refresh or fetched is None or time.monotonic() - fetched > self.ttl:
+                self._bans[guild.id] = await fetch(guild)
+                self._fetched[guild.id] = time.monotonic()
+            return self._bans[guild.id]
+
+    def peek(self, guild_id):
+        """
+        Gives a server's cached ban list without fetching it.
+
+        Input: Server ID
+        Output: BanIds, or None if the server is not cached
+        """
+        return self._bans.get(guild_id)
+
+    def add(self, guild_id, user_id):
+        """
+        Records a ban on a cached server.
+        """
+        if guild_id in self._bans:
+            self._bans[guild_id].add(user_id)
+
+    def discard(self, guild_id, user_id):
+        """
+        Records an unban on a cached server.
+        """
+        if guild_id in self._bans:
+            self._bans[guild_id].discard(user_id)
+
+    def invalidate(self, guild_id):
+        """
+        Forgets a server's ban list.
+        """
+        self._bans.pop(guild_id, None)
+        self._fetched.pop(guild_id, None)
+        self._locks.pop(guild_id, None)
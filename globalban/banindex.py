@@ -0,0 +1,122 @@
+import bisect
+import itertools
+
+
+class BanIndex:
+    """
+    The in-memory index of every global ban.
+
+    Bans can be looked up by user ID like a dictionary. Next to that the index keeps
+    the bans sorted by lowercase name and by the time they end, so a page of the
+    ban list can be cut out without going through or formatting every ban.
+
+    Usage: index.put(ban), index.remove(user_id), index.page(2, 20, name='bob')
+    """
+
+    def __init__(self, bans=()):
+        """
+        Input: GlobalBans to start with
+        Output: Nothing
+        """
+        self._bans = {}
+        self._keys = {}
+        for ban in bans:
+            self._bans[ban.user_id] = ban
+            self._keys[ban.user_id] = (ban.name.lower(), ban.reason.lower())
+        self._by_name = sorted((key[0], id) for id, key in self._keys.items())
+        self._by_bantime = sorted((ban.bantime, id) for id, ban in self._bans.items())
+
+    def __contains__(self, user_id):
+        return user_id in self._bans
+
+    def __getitem__(self, user_id):
+        return self._bans[user_id]
+
+    def __iter__(self):
+        return iter(self._bans)
+
+    def __len__(self):
+        return len(self._bans)
+
+    def get(self, user_id, default=None):
+        return self._bans.get(user_id, default)
+
+    def values(self):
+        return self._bans.values()
+
+    def put(self, ban):
+        """
+        Adds or replaces a ban.
+
+        Input: GlobalBan
+        Output: Nothing
+        """
+        self.remove(ban.user_id)
+        self._bans[ban.user_id] = ban
+        self._keys[ban.user_id] = (ban.name.lower(), ban.reason.lower())
+        bisect.insort(self._by_name, (self._keys[ban.user_id][0], ban.user_id))
+        bisect.insort(self._by_bantime, (ban.bantime, ban.user_id))
+
+    def remove(self, user_id):
+        """
+        Removes a ban if it is there.
+
+        Input: User ID
+        Output: The removed GlobalBan or None
+        """
+        ban = self._bans.pop(user_id, None)
+        if ban is None:
+            return None
+        name, reason = self._keys.pop(user_id)
+        self._discard(self._by_name, (name, user_id))
+        self._discard(self._by_bantime, (ban.bantime, user_id))
+        return ban
+
+    @staticmethod
+    def _discard(entries, entry):
+        position = bisect.bisect_left(entries, entry)
+        if position < len(entries) and entries[position] == entry:
+            del entries[position]
+
+    def search(self, name=None, reason=None, ends_after=None, ends_before=None):
+        """
+        Goes through the bans that match the filters, one at a time.
+
+        Bans are given sorted by name, or by the time they end when a time range is given.
+
+        Input: Text the name or reason has to contain and the range the ban has to end in
+        Output: A generator of GlobalBans
+        """
+        if ends_after is not None or ends_before is not None:
+            start = 0 if ends_after is None else bisect.bisect_left(self._by_bantime, (ends_after,))
+            end = len(self._by_bantime) if ends_before is None else bisect.bisect_right(self._by_bantime, (ends_before, float('inf')))
+            entries = itertools.islice(self._by_bantime, start, end)
+        else:
+            entries = iter(self._by_name)
+        name = name.lower() if name is not None else None
+        reason = reason.lower() if reason is not None else None
+        for key, id in entries:
+            name_key, reason_key = self._keys[id]
+            if name is not None and name not in name_key:
+                continue
+            if reason is not None and reason not in reason_key:
+                continue
+            yield self._bans[id]
+
+    def page(self, number, size, **filters):
+        """
+        Cuts one page out of the (filtered) ban list.
+
+        Without filters this only touches the bans on the page. With filters it
+        stops as soon as the page is full.
+
+        Input: Page number starting at 1, bans per page and filters for search
+        Output: (list of GlobalBans on the page, whether there is a next page)
+        """
+        start = (number - 1) * size
+        if not any(value is not None for value in filters.values()):
+            ids = self._by_name[start:start + size + 1]
+            bans = [self._bans[id] for key, id in ids]
+        else:
+            bans = list(itertools.islice(self.search(**filters), start, start + size + 1))
+        return bans[:size], len(bans) > size
@@ -1,9 +1,62 @@
 from redbot.core import commands, Config
+from redbot.core.data_manager import cog_data_path
 import discord
 from discord.ext.commands import UserConverter, has_permissions
 import asyncio
 from datetime import date, datetime, timedelta
+import functools
+import heapq
+import itertools
+import logging
+import os
+import shlex
+import sqlite3
 import time
+from typing import Optional
+
+from .bancache import BanCache, BanIds
+from .banindex import BanIndex
+from .metrics import SyncMetrics
+from .ratelimit import RateLimiter
+from .records import FOREVER_BANTIME, GlobalBan, parse_duration
+from .schedule import Schedule
+from .storage import ConfigBanStore, SQLiteBanStore, migrate, move_store
+from .transfer import FORMATS, read_bans, write_bans
+
+log = logging.getLogger('red.globalban')
+
+# How many guilds are synced at the same time.
+SYNC_CONCURRENCY = 8
+# How many seconds ban changes are collected before they are written to storage.
+FLUSH_DELAY = 5
+# How many bans are shown on one page of globalbans, and how many characters of a ban's name, reason
+# and whole line are shown. 10 lines of at most 170 characters, plus the header and footer, always fit
+# in one 2000 character Discord message.
+BANS_PER_PAGE = 10
+NAME_LENGTH = 32
+REASON_LENGTH = 60
+LINE_LENGTH = 170
+# How many outbox entries are applied in one go, how often one is tried before giving up
+# and how many seconds the first retry waits. Every retry after that waits twice as long, up to an hour.
+OUTBOX_BATCH = 500
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF = 30
+# When at least this many bans for one server come out of the outbox at once, or an incremental
+# sync has that many to push, the server's ban list is fetched first so the bans it already has are skipped.
+OUTBOX_FETCH_BANS = 20
+# How many seconds between checks for ban changes made by other processes sharing the ban storage.
+COORDINATION_INTERVAL = 5
+# How many seconds the scheduler sleeps at most, so servers added to the synced list get their time soon.
+SCHEDULE_CHECK = 60
+# How many bans are applied between two progress updates when a server is added.
+ONBOARD_PROGRESS = 100
+# How many bans are fetched per request when reading a server's ban list. 1000 is the most Discord allows.
+BAN_PAGE_SIZE = 1000
+# How many seconds bans and unbans done by hand on synced servers are collected before mirror mode
+# turns them into global ones, and how many seconds after the cog bans or unbans someone itself
+# the event Discord sends back is recognised as its own.
+MIRROR_DELAY = 3
+ECHO_WINDOW = 5 * 60
 
 
 class BanSync(commands.Cog):
@@ -13,11 +66,19 @@ class BanSync(commands.Cog):
     Commands :
         [p]globalban <name> or <name#discrim> or <mention> or <id>: Bans a user from all connected servers.
         [p]globalunban <id>: Unbans a user from all connected servers.
-        [p]globalbans: Gives all the people who are banned.
+        [p]globalbans [page] [filters]: Gives all the people who are banned, one page at a time.
         [p]bansync: Syncs all global bans across all servers.
+        [p]syncstatus: Shows how far the current sync is and how long it should still take.
         [p]syncedservers: Shows all the synced servers.
-        [p]sync: Adds a server to the synced list if it is not already there and re-syncs all the global bans.
+        [p]sync: Adds a server to the synced list if it is not already there and applies all the global bans to it.
+        [p]autosync <on/off>: Adds every server the bot joins to the synced list.
         [p]delsync: Removes a server from the synced server list.
+        [p]syncstats: Shows how the syncs have been doing and which servers were the slowest.
+        [p]slowguild <seconds>: Logs every server whose sync takes longer than this.
+        [p]banstorage <path>: Moves the ban storage to a file that several bot processes can share.
+        [p]exportbans [jsonl/csv]: Sends every global ban as a file.
+        [p]mirror <on/off>: Turns bans and unbans done by hand on a synced server into global ones.
+        [p]importbans [jsonl/csv]: Adds the global bans in the attached file and applies them to every synced server.
     """
 
     def __init__(self, bot):
@@ -31,11 +92,32 @@ class BanSync(commands.Cog):
         commands.Cog.__init__(self)
         self.bot = bot
         self.config = Config.get_conf(self, identifier=1001)
+        self.config.register_global(ban_revision=0, ban_revisions={}, watermarks={}, stale_guilds=[], migrated=False, slow_guild_seconds=0, sync_jobs={}, sync_schedules={}, storage_path=None, auto_sync=False, mirror=False)
+        self.store = None
+        self.seen_revision = 0
+        self.bans = BanIndex()
+        self.dirty = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.own_actions = {}
+        self.mirror_events = {}
+        self.mirror_task = None
         self.initiate = self.bot.loop.create_task(self.initiate())
-        self.to_time = 0
         self.scheduled = 'weekly'
-        self.task = self.bot.loop.create_task(self.bansync_scheduled())
+        self.sync_concurrency = SYNC_CONCURRENCY
+        self.metrics = SyncMetrics()
+        self.ratelimiter = RateLimiter(on_429=self.metrics.ratelimited)
+        self.bancache = BanCache()
+        self.sync_lock = asyncio.Lock()
+        self.checkpoint_lock = asyncio.Lock()
+        self.sync_progress = None
+        self.task = self.bot.loop.create_task(self.run_schedule())
+        self.expiry_heap = []
+        self.expiry_wakeup = asyncio.Event()
         self.tempbans = self.bot.loop.create_task(self.checktempbans())
+        self.outbox_wakeup = asyncio.Event()
+        self.outbox = self.bot.loop.create_task(self.run_outbox())
+        self.coordination = self.bot.loop.create_task(self.run_coordination())
 
     async def initiate(self):
         """
@@ -65,63 +147,354 @@ class BanSync(commands.Cog):
         else:
             self.scheduled = await self.config.scheduled()
             self.scheduled = self.scheduled[0]
+        storage_path = await self.config.storage_path()
+        self.store = SQLiteBanStore(storage_path or cog_data_path(self) / 'bans.sqlite3')
+        if not await self.config.migrated():
+            await migrate(ConfigBanStore(self.config), self.store)
+            await self.config.migrated.set(True)
+        self.seen_revision = await self.store.revision()
+        self.bans = BanIndex((await self.store.all()).values())
+
+    async def cog_before_invoke(self, ctx):
+        """
+        Makes commands wait until the global bans are loaded.
+        """
+        await self.initiate
+
+    def cog_unload(self):
+        """
+        Stops the background tasks, then writes any unsaved ban changes and closes the ban storage.
+        """
+        self.initiate.cancel()
+        self.task.cancel()
+        self.tempbans.cancel()
+        self.outbox.cancel()
+        self.coordination.cancel()
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        if self.mirror_task is not None:
+            self.mirror_task.cancel()
+        self.bot.loop.create_task(self.close_store())
+
+    async def close_store(self):
+        if self.store is None:
+            return
+        await self.flush()
+        self.store.close()
+
+    def shards(self):
+        """
+        Gives the shards this process runs, for when the bot is split over several processes.
+
+        Input: Nothing
+        Output: (shard count, list of shard IDs), or None if this process runs every shard
+        """
+        shard_count = getattr(self.bot, 'shard_count', None)
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if shard_ids is None and getattr(self.bot, 'shard_id', None) is not None:
+            shard_ids = [self.bot.shard_id]
+        if not shard_count or shard_ids is None or len(shard_ids) >= shard_count:
+            return None
+        return shard_count, list(shard_ids)
+
+    def owns_guild(self, server_id):
+        """
+        Checks if a server is on one of the shards this process runs.
+        Only those servers are synced and have their outbox entries applied by this process.
+
+        Input: Server ID
+        Output: True or False
+        """
+        shards = self.shards()
+        if shards is None:
+            return True
+        shard_count, shard_ids = shards
+        return (server_id >> 22) % shard_count in shard_ids
+
+    def partition(self):
+        """
+        Output: The key this process' sync jobs are saved under, like '0,1/4', or 'all'
+        """
+        shards = self.shards()
+        if shards is None:
+            return 'all'
+        shard_count, shard_ids = shards
+        return '{}/{}'.format(','.join(str(id) for id in sorted(shard_ids)), shard_count)
 
-    async def bansync_scheduled(self):
+    def is_leader(self):
         """
-        An looped task the runs once every
+        Checks if this process runs shard 0. Work that only has to happen once for the
+        whole bot, like lifting tempbans, is done by that process.
 
         Input: Nothing
-        Output: A server sync for all the global bans once a week.
+        Output: True or False
+        """
+        shards = self.shards()
+        return shards is None or 0 in shards[1]
+
+    async def run_coordination(self):
         """
+        Picks up the ban changes other processes write to a shared ban storage.
+
+        Input: Nothing
+        Output: Nothing
+        """
+        await self.initiate
         while True:
+            await asyncio.sleep(COORDINATION_INTERVAL)
+            try:
+                await self.pull_changes()
+            except Exception:
+                log.exception('Could not read the ban changes of other processes.')
+
+    async def pull_changes(self):
+        """
+        Applies the ban changes made since the last check to the in-memory bans.
+        Bans changed here that are not flushed yet are left alone, and so are this
+        process' own flushed changes, which come back unchanged.
+
+        Input: Nothing
+        Output: Nothing
+        """
+        # Holding flush_lock keeps banstorage from switching the store in the middle.
+        async with self.flush_lock:
+            revision = await self.store.revision()
+            if revision == self.seen_revision:
+                return
+            changes = await self.store.changes_since(self.seen_revision)
+            self.seen_revision = revision
+        for id, ban in changes.items():
+            if id in self.dirty:
+                continue
+            current = self.bans.get(id)
+            if ban is None:
+                self.bans.remove(id)
+            elif current is None or (current.name, current.reason, current.bantime, current.duration) != (ban.name, ban.reason, ban.bantime, ban.duration):
+                self.bans.put(ban)
+                if not ban.forever and (current is None or current.bantime != ban.bantime):
+                    self.schedule_expiry(ban.user_id, ban.bantime)
+
+    def put_ban(self, ban):
+        """
+        Adds or replaces a global ban. It is written to storage by the next flush.
+
+        Input: GlobalBan
+        Output: Nothing
+        """
+        self.bans.put(ban)
+        self.dirty[ban.user_id] = ban
+        self.schedule_flush()
+
+    def remove_bans(self, *ids):
+        """
+        Removes global bans. They are removed from storage by the next flush.
+
+        Input: User IDs
+        Output: Nothing
+        """
+        for id in ids:
+            self.bans.remove(id)
+            self.dirty[id] = None
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        """
+        Writes ban changes to storage after FLUSH_DELAY seconds, so a burst of
+        changes turns into one write.
+        """
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = self.bot.loop.create_task(self.flush_later())
+
+    async def flush_later(self):
+        while True:
+            await asyncio.sleep(FLUSH_DELAY)
+            try:
+                await self.flush()
+                return
+            except Exception:
+                log.exception('Saving the ban changes failed, trying again in %s seconds.', FLUSH_DELAY)
+
+    async def flush(self):
+        """
+        Writes every ban change since the last flush to storage.
+        If the write fails, the changes are kept for the next flush, unless newer ones were made meanwhile.
+
+        Input: Nothing
+        Output: Nothing, raises the storage error if the write fails
+        """
+        async with self.flush_lock:
+            dirty, self.dirty = self.dirty, {}
+            upserts = [ban for ban in dirty.values() if ban is not None]
+            deletes = [id for id, ban in dirty.items() if ban is None]
+            try:
+                if len(upserts) > 0:
+                    await self.store.upsert_many(upserts)
+                if len(deletes) > 0:
+                    await self.store.delete(*deletes)
+            except Exception:
+                for id, ban in dirty.items():
+                    self.dirty.setdefault(id, ban)
+                raise
+
+    async def run_schedule(self):
+        """
+        Runs the scheduled syncs.
+
+        Instead of syncing every server at once when the schedule comes round, the period
+        until the schedule's next run is cut into one slot per synced server and every server
+        is synced at a random time inside its slot, so the API sees a steady trickle instead
+        of a spike. The times are saved in the config, so a restart carries on with them
+        instead of syncing everything straight away. Servers whose time passed while the
+        bot was down are spread over what is left of the period.
+
+        A new or changed schedule starts its first period straight away and it runs until
+        the schedule's next run, so no server waits longer than one period for its sync.
+        An error while starting up or in one pass is logged and the scheduler carries on.
+
+        Input: Nothing
+        Output: Scheduled syncs of every server, once per period of the schedule.
+        """
+        await self.initiate
+        while True:
+            try:
+                schedule, state = await self.start_schedule()
+                break
+            except Exception:
+                log.exception('Starting the scheduled syncs failed.')
+                await asyncio.sleep(SCHEDULE_CHECK)
+
+        while True:
+            try:
+                state = await self.schedule_pass(schedule, state)
+            except Exception:
+                log.exception('A scheduled sync failed.')
+                await asyncio.sleep(SCHEDULE_CHECK)
+
+    async def start_schedule(self):
+        """
+        Finishes a sync job left over from before a restart, then picks up the saved
+        period or plans a new one.
+
+        Input: Nothing
+        Output: (Schedule, the current period)
+        """
+        if (await self.config.sync_jobs()).get(self.partition()) is not None:
             await self.bansync_root()
-            time = datetime.now()
-            month, day, day_num, hour, minutes, seconds = int(time.strftime('%m')), time.strftime('%a'), int(time.strftime('%d')), int(time.strftime('%H')), int(time.strftime('%M')), int(time.strftime('%S'))
-            days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-            month_length = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-
-            if self.scheduled == 'daily':
-                self.to_time = ((60 - minutes) * 60) + (60 - seconds)
-                self.to_time += (24 - hour - 1) * 60 * 60
-                await self.bot.get_channel(self.sync_send_message).send('Done. The bans will now sync {}. Time to sleep: {}'.format(self.scheduled, self.to_time))
-                await asyncio.sleep(self.to_time)
-            elif self.scheduled == 'weekly':
-                self.to_time = ((60 - minutes) * 60) + (60 - seconds)
-                self.to_time += (24 - hour - 1) * 60 * 60
-                self.to_time += (7-(days.index(day) + 1)) * 24 * 60 * 60
-                await self.bot.get_channel(self.sync_send_message).send('Done. The bans will now sync {}. Time to sleep: {}'.format(self.scheduled, self.to_time))
-                await asyncio.sleep(self.to_time)
-            elif self.scheduled == 'monthly':
-                self.to_time = ((60-minutes) * 60) + (60-seconds)
-                self.to_time += (24 - hour - 1) * 60 * 60
-                self.to_time += (month_length[int(month)-1] - day_num) * 24 * 60 * 60
-                await self.bot.get_channel(self.sync_send_message).send('Done. The bans will now sync {}. Time to sleep: {}'.format(self.scheduled, self.to_time))
-                await asyncio.sleep(self.to_time)
+        schedule = Schedule(self.scheduled)
+        servers = [server for server in await self.config.synced_servers() if self.owns_guild(server)]
+        state = (await self.config.sync_schedules()).get(self.partition())
+        now = time.time()
+        if state is not None and state['spec'] == self.scheduled and state['end'] > now:
+            late = [int(server) for server, at in state['guilds'].items() if at < now]
+            state['guilds'].update(self.spread(late, now, state['end']))
+        else:
+            state = self.plan_period(schedule, now, servers, schedule.first_end(now))
+        await self.save_schedule(state)
+        return schedule, state
+
+    async def schedule_pass(self, schedule, state):
+        """
+        Syncs the servers whose time has come, or sleeps until the next one's time.
+
+        Input: Schedule and the current period
+        Output: The current period, which is a new one if the last one ended
+        """
+        now = time.time()
+        servers = [server for server in await self.config.synced_servers() if self.owns_guild(server)]
+        changed = False
+        if now >= state['end']:
+            state = self.plan_period(schedule, state['end'], servers)
+            changed = True
+        guilds = state['guilds']
+        synced, done = set(servers), set(state['done'])
+        for server in [server for server in guilds if int(server) not in synced]:
+            del guilds[server]
+            changed = True
+        added = [server for server in servers if str(server) not in guilds and server not in done]
+        if len(added) > 0:
+            guilds.update(self.spread(added, max(now, state['start']), state['end']))
+            changed = True
+        due = [int(server) for server, at in guilds.items() if at <= now]
+        if len(due) > 0:
+            await self.sync_scheduled(due)
+            for server in due:
+                guilds.pop(str(server), None)
+                state['done'].append(server)
+            changed = True
+        if changed:
+            await self.save_schedule(state)
+        if len(due) == 0:
+            next_time = min(list(guilds.values()) + [state['end']])
+            await asyncio.sleep(min(max(next_time - time.time(), 0), SCHEDULE_CHECK))
+        return state
+
+    def plan_period(self, schedule, start, servers, end=None):
+        """
+        Gives every server its sync time in the period from start until end,
+        or until the schedule's next run if end is left out.
+
+        Input: Schedule, the time the period starts, the IDs of the servers to sync and optionally the time it ends
+        Output: The period as it is saved in the config
+        """
+        if end is None:
+            end = schedule.next_run(start)
+        return {'spec': self.scheduled, 'start': start, 'end': end, 'guilds': self.spread(servers, max(start, time.time()), end), 'done': []}
+
+    @staticmethod
+    def spread(servers, start, end):
+        """
+        Output: Dictionary of server ID (as text, like every config key) -> Unix time to sync it at
+        """
+        return {str(server): at for server, at in Schedule.spread(servers, start, end).items()}
+
+    async def save_schedule(self, state):
+        async with self.config.sync_schedules() as sync_schedules:
+            sync_schedules[self.partition()] = state
+
+    async def sync_scheduled(self, servers):
+        """
+        Syncs the servers whose scheduled time has come. Nothing is saved as a job,
+        the schedule itself keeps the servers until their sync is done.
+
+        Input: List of server IDs
+        Output: Nothing
+        """
+        async with self.sync_lock:
+            job = {'started': time.time(), 'full': False, 'guilds': servers, 'done': [], 'failed': [], 'banned': 0, 'scheduled': True}
+            await self.run_sync_job(job)
+            self.sync_progress = None
+        if len(job['failed']) > 0:
+            await self.report_failure(job['failed'])
 
     @has_permissions(ban_members=True)
     @commands.command()
     async def synctime(self, ctx, *, schedule_at):
         """
-        Changes the time when the bot automatically syncs all the bans.
+        Changes when the bot automatically syncs all the bans.
+
+        The schedule can be daily, weekly, monthly, an interval written like in globalban
+        (e.g. 12H) or a cron spec (minute hour day month weekday, e.g. 0 3 * * 1).
+        Every server is synced once per period, at its own time within the period.
 
         Input: Scheduled Time
         Output: Nothing
 
-        Usage: [p]synctime <'Daily' Or 'Weekly' Or 'Monthly'>
+        Usage: [p]synctime <'Daily' Or 'Weekly' Or 'Monthly' Or interval Or cron spec>
         """
         try:
             schedule_at = schedule_at.lower()
-            if schedule_at in ('daily', 'weekly', 'monthly'):
-                async with self.config.scheduled() as scheduled:
-                    scheduled[0] = schedule_at
-                    self.scheduled = schedule_at
-                    self.task.cancel()
-                    self.sync_send_message = ctx.channel.id
-                    self.task = self.bot.loop.create_task(self.bansync_scheduled())
-            else:
-                await ctx.send('Oops, please use daily, weekly or monthly.')
-        except AttributeError:
-            await ctx.send('Oops, please use daily, weekly or monthly.')
+            schedule = Schedule(schedule_at)
+            async with self.config.scheduled() as scheduled:
+                scheduled[0] = schedule_at
+                self.scheduled = schedule_at
+                self.task.cancel()
+                self.task = self.bot.loop.create_task(self.run_schedule())
+            first_end = datetime.fromtimestamp(schedule.first_end(time.time()))
+            await ctx.send('Done. The bans will now sync {}. The first period starts now and runs until {}. Every server is synced at its own time within each period.'.format(
+                self.scheduled, first_end.strftime('%Y-%m-%d %H:%M')
+            ))
+        except (AttributeError, ValueError):
+            await ctx.send('Oops, please use daily, weekly, monthly, an interval like 12H or a cron spec like 0 3 * * 1.')
         except Exception as ex:
             await ctx.send('Something went wrong, but im not sure what. Please check how to use the command.')
 
@@ -134,87 +507,952 @@ class BanSync(commands.Cog):
         message = "I have not been setup correctly. ( Check if i'm admin or if I can ban/unban other players. ) \nThe BanSync failed on these servers: \n"
         for number, failure in enumerate(failed_servers):
             message += '\n{}. {}'.format(number + 1, failure)
-        await Owner.send(message)
+        try:
+            await Owner.send(message)
+        except discord.errors.HTTPException:
+            log.warning('Could not tell the owner that the sync failed on: %s', ', '.join(str(failure) for failure in failed_servers))
+            return False
         return True
 
-    async def bansync_root(self):
+    async def bansync_root(self, full=False, resume=True):
         """
         Checks through ever connected server and checks if every user in
         global ban dictionary is banned. If not, it re-bans them.
 
-        Input: Nothing
+        Up to sync_concurrency servers are synced at the same time, so a full
+        sync takes about as long as the slowest server instead of all of them added up.
+
+        Every server remembers the last ban revision it has applied. Unless full is True,
+        servers that are not stale only get the bans added since that revision, and only
+        stale servers have their ban list fetched and compared against the global bans.
+
+        A sync is saved as a job in the config and every finished server is checkpointed,
+        so if the bot restarts in the middle, the next sync carries on with the servers
+        that were left instead of starting over.
+
+        When the bot is split over several processes, each one only syncs the servers on
+        its own shards and keeps its own job.
+
+        Input: Whether to rescan every server and whether to carry on with an unfinished sync
         Output: A server sync for all the global bans.
         """
-        async with self.config.global_bans() as global_bans:
-            failed_servers = []
-            async with self.config.synced_servers() as servers:
-                for server in servers:
+        async with self.sync_lock:
+            partition = self.partition()
+            job = (await self.config.sync_jobs()).get(partition)
+            if job is None or not resume:
+                servers = [server for server in await self.config.synced_servers() if self.owns_guild(server)]
+                job = {'started': time.time(), 'full': full, 'guilds': servers, 'done': [], 'failed': [], 'banned': 0}
+                await self.save_job(job)
+            else:
+                log.info('Resuming the sync started at %s with %s of %s servers done.', job['started'], len(job['done']), len(job['guilds']))
+            await self.run_sync_job(job)
+            await self.save_job(None)
+            self.sync_progress = None
+
+        if len(job['failed']) > 0:
+            await self.report_failure(job['failed'])
+
+    async def save_job(self, job):
+        """
+        Saves this process' sync job, or removes it when job is None.
+        """
+        async with self.config.sync_jobs() as sync_jobs:
+            if job is None:
+                sync_jobs.pop(self.partition(), None)
+            else:
+                sync_jobs[self.partition()] = job
+
+    async def run_sync_job(self, job):
+        """
+        Syncs every server of a sync job that has not been checkpointed yet.
+
+        Input: The sync job
+        Output: Nothing
+        """
+        started = time.monotonic()
+        await self.flush()
+        await self.pull_changes()
+        revision = await self.store.revision()
+        global_ids = set(self.bans)
+        watermarks = await self.config.watermarks()
+        stale_guilds = set(await self.config.stale_guilds())
+        done = set(job['done'])
+        servers = [server for server in job['guilds'] if server not in done]
+        self.sync_progress = {'job': job, 'started': started, 'done': 0}
+
+        added_since = {}
+        semaphore = asyncio.Semaphore(self.sync_concurrency)
+        jobs = []
+        for server in servers:
+            watermark = watermarks.get(str(server))
+            if job['full'] or watermark is None or server in stale_guilds:
+                sync = self.sync_guild(server, global_ids, semaphore, full=job['full'])
+            else:
+                if watermark not in added_since:
+                    added_since[watermark] = await self.store.added_since(watermark)
+                sync = self.sync_guild(server, global_ids, semaphore, added_since[watermark])
+            jobs.append(self.checkpoint(job, server, sync, revision))
+        results = await asyncio.gather(*jobs)
+
+        missing = [server for server, result in zip(servers, results) if result is None]
+        if len(missing) > 0:
+            async with self.config.synced_servers() as synced_servers:
+                for server in missing:
+                    if server in synced_servers:
+                        synced_servers.remove(server)
+
+        await self.record_metrics(results, time.monotonic() - started)
+
+    async def checkpoint(self, job, server, sync, revision):
+        """
+        Runs the sync of one server and saves in the sync job that it is done.
+        If the server was synced, its watermark moves to the revision the job started from.
+
+        Input: The sync job, server ID, the server's sync_guild coroutine and the revision
+        Output: The result of sync_guild
+        """
+        result = await sync
+        async with self.checkpoint_lock:
+            if result is not None and result['error'] is None:
+                await self.set_watermark(server, revision)
+            if result is not None:
+                job['banned'] += result['banned']
+                if result['error'] is not None:
+                    job['failed'].append(result['name'])
+            job['done'].append(server)
+            if not job.get('scheduled'):
+                await self.save_job(job)
+            self.sync_progress['done'] += 1
+        return result
+
+    async def set_watermark(self, server, revision):
+        """
+        Saves that a server has every ban up to a revision and is no longer stale.
+
+        Input: Server ID and revision
+        Output: Nothing
+        """
+        async with self.config.watermarks() as watermarks:
+            watermarks[str(server)] = revision
+        async with self.config.stale_guilds() as stale:
+            if server in stale:
+                stale.remove(server)
+
+    async def onboard_guild(self, server, progress=None):
+        """
+        Applies every global ban to one server that was just added to the synced list,
+        without touching the other synced servers. The server's ban list is fetched once,
+        and the missing bans are applied in order with a progress update every ONBOARD_PROGRESS bans.
+
+        Input: Server and optionally a coroutine function called with (bans applied, bans to apply)
+        Output: The result of sync_guild
+        """
+        await self.flush()
+        await self.pull_changes()
+        revision = await self.store.revision()
+        result = await self.sync_guild(server.id, set(self.bans), asyncio.Semaphore(1), full=True, progress=progress)
+        if result is not None and result['error'] is None:
+            async with self.checkpoint_lock:
+                await self.set_watermark(server.id, revision)
+        await self.record_metrics([result], 0 if result is None else result['seconds'])
+        return result
+
+    @has_permissions(ban_members=True)
+    @commands.command()
+    async def syncstatus(self, ctx):
+        """
+        Shows how far the current sync is and how long it should still take.
+
+        Input: CTX
+        Output: A message with the progress of the sync.
+        """
+        progress = self.sync_progress
+        if progress is not None:
+            job = progress['job']
+        else:
+            job = (await self.config.sync_jobs()).get(self.partition())
+        if job is None:
+            await ctx.send('There is no sync running right now.')
+            return
+        kind = 'full' if job['full'] else 'scheduled' if job.get('scheduled') else 'incremental'
+        total, done = len(job['guilds']), len(job['done'])
+        message = 'Sync started {} ({}):\n'.format(datetime.fromtimestamp(job['started']).strftime('%Y-%m-%d %H:%M:%S'), kind)
+        message += '\n{} of {} servers done ({:.0f}%), {} bans applied.'.format(done, total, 100 * done / max(total, 1), job['banned'])
+        if len(job['failed']) > 0:
+            message += '\nFailed on: {}'.format(', '.join(job['failed']))
+        if progress is None:
+            message += '\nThe sync is not running right now. It will carry on with the next sync.'
+        elif progress['done'] > 0:
+            elapsed = time.monotonic() - progress['started']
+            eta = elapsed / progress['done'] * (total - done)
+            message += '\nAbout {} left.'.format(str(timedelta(seconds=int(eta))))
+        await ctx.send(message)
+
+    async def record_metrics(self, results, seconds):
+        """
+        Adds a finished sync to the metrics, writes them to metrics.prom in the
+        cog's data folder and logs the servers slower than slow_guild_seconds.
+
+        Input: The per server results of sync_guild and how long the whole sync took
+        Output: Nothing
+        """
+        self.metrics.record_sync(results, seconds)
+        try:
+            self.metrics.write_prometheus(cog_data_path(self) / 'metrics.prom')
+        except OSError:
+            log.exception('Could not write the sync metrics.')
+        slow_guild_seconds = await self.config.slow_guild_seconds()
+        if slow_guild_seconds > 0:
+            for result in results:
+                if result is not None and result['seconds'] > slow_guild_seconds:
+                    log.warning(
+                        'Syncing %s (%s) took %.1f seconds (fetch: %s, banned: %s, error: %s).',
+                        result['name'], result['id'], result['seconds'], result['fetch_seconds'], result['banned'], result['error']
+                    )
+
+    async def sync_guild(self, server_id, global_ids, semaphore, pending=None, full=False, progress=None):
+        """
+        Bans everyone in the global ban set that is not yet banned on one server.
+
+        Input: Server ID, set of globally banned IDs, the semaphore limiting how many servers
+               sync at once, optionally the IDs to push (the ones the server's cached ban list
+               already has are left out, and a long list fetches the ban list first),
+               whether to refetch the server's bans instead of using the cache and optionally
+               a coroutine function called with (bans applied, bans to apply) every ONBOARD_PROGRESS bans
+        Output: None if the server is gone, otherwise a dictionary with the server's ID and name,
+                how many users were banned or skipped, if the bot was forbidden, the error that
+                stopped the sync (None if it finished) and how long fetching the ban list and
+                the whole sync took.
+
+        A user Discord does not know any more (a deleted account) is skipped. Any other API
+        error, including a 429 that is still there after the retries, stops this server's
+        sync only, so the other servers carry on.
+        """
+        server = self.bot.get_guild(server_id)
+        if server is None:
+            return None
+        result = {'id': server.id, 'name': server.name, 'banned': 0, 'skipped': 0, 'forbidden': False, 'error': None, 'fetch_seconds': None, 'seconds': 0.0}
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                if pending is None:
+                    bans = await self.bancache.get(server, self.fetch_ban_ids, refresh=full)
+                    result['fetch_seconds'] = time.monotonic() - started
+                    pending = {id for id in global_ids if id not in bans}
+                    result['skipped'] = len(global_ids) - len(pending)
+                else:
+                    # The outbox has usually applied these bans already.
+                    bans = self.bancache.peek(server.id)
+                    if bans is None and len(pending) >= OUTBOX_FETCH_BANS:
+                        bans = await self.bancache.get(server, self.fetch_ban_ids)
+                        result['fetch_seconds'] = time.monotonic() - started
+                    if bans is not None:
+                        result['skipped'] = len(pending)
+                        pending = {id for id in pending if id not in bans}
+                        result['skipped'] -= len(pending)
+                for id in pending:
+                    ban = functools.partial(server.ban, discord.Object(id=id), delete_message_days=0)
+                    self.expect_echo(server.id, id, 'ban')
                     try:
-                        server = self.bot.get_guild(server)
-                        if server is None:
-                            del servers[servers.index(server)]
-                            continue
-                        bans = [b.user.id for b in await server.bans()]
-                        for id, name in global_bans.items():
-                            id = int(id)
-                            if id not in bans:
-                                await self.bot.get_guild(server.id).ban(discord.Object(id=id), delete_message_days=0)
-                    except discord.errors.Forbidden:
-                        failed_servers.append(server.name)
-
-            if len(failed_servers) > 0:
-                await self.report_failure(failed_servers)
+                        await self.ratelimiter.call(('ban', server.id), ban)
+                    except discord.errors.NotFound:
+                        result['skipped'] += 1
+                        continue
+                    self.bancache.add(server.id, id)
+                    result['banned'] += 1
+                    if progress is not None and result['banned'] % ONBOARD_PROGRESS == 0:
+                        await progress(result['banned'], len(pending))
+            except discord.errors.Forbidden:
+                result['forbidden'] = True
+                result['error'] = 'Forbidden'
+            except discord.errors.HTTPException as ex:
+                result['error'] = '{} {}'.format(ex.status, ex.text or type(ex).__name__)
+                log.warning('Syncing %s (%s) stopped on an API error: %s', server.name, server.id, result['error'])
+            result['seconds'] = time.monotonic() - started
+        return result
+
+    async def fetch_ban_ids(self, server):
+        """
+        Fetches the IDs of everyone banned on a server.
+
+        The ban list is read one page of BAN_PAGE_SIZE bans at a time, ordered by user ID,
+        and only the IDs are kept, in BanIds, so no more than one page of ban entries is in memory
+        at once and the cached list takes 8 bytes per ban.
+
+        Input: Server
+        Output: BanIds of the banned IDs
+        """
+        ids = BanIds()
+        after = None
+        while True:
+            page, last = await self.ratelimiter.call(('bans', server.id), functools.partial(self.fetch_ban_page, server, after))
+            ids.update(page)
+            if last or len(page) == 0:
+                return ids
+            after = max(page)
+
+    @staticmethod
+    async def fetch_ban_page(server, after=None):
+        """
+        Fetches one page of a server's ban list.
+
+        discord.py 2 gives the bans as an async iterator that can start after a user ID.
+        discord.py 1 can only give the whole list at once, so then it is one page.
+
+        Input: Server and the user ID to start after, or None to start at the beginning
+        Output: (list of banned IDs, whether this is the last page)
+        """
+        try:
+            entries = server.bans(limit=BAN_PAGE_SIZE, **({} if after is None else {'after': discord.Object(id=after)}))
+        except TypeError:
+            return [entry.user.id for entry in await server.bans()], True
+        page = [entry.user.id async for entry in entries]
+        return page, len(page) < BAN_PAGE_SIZE
+
+    async def mark_stale(self, server_id):
+        """
+        Makes the next sync rescan a server's full ban list.
+
+        Input: Server ID
+        Output: Nothing
+        """
+        async with self.config.stale_guilds() as stale_guilds:
+            if server_id not in stale_guilds:
+                stale_guilds.append(server_id)
+
+    def expect_echo(self, server_id, user_id, action):
+        """
+        Remembers that the cog is about to ban or unban someone, so the event
+        Discord sends back for it is not taken for a ban or unban done by hand.
+
+        Input: Server ID, user ID and 'ban' or 'unban'
+        Output: Nothing
+        """
+        key = (server_id, user_id)
+        self.own_actions.pop(key, None)
+        self.own_actions[key] = (action, time.monotonic() + ECHO_WINDOW)
+        # Entries are kept in the order they expire, so the expired ones are at the front.
+        now = time.monotonic()
+        for old_key, (old_action, expires) in list(itertools.islice(self.own_actions.items(), 2)):
+            if expires < now:
+                del self.own_actions[old_key]
+
+    def is_echo(self, server_id, user_id, action):
+        """
+        Checks if a ban or unban event was caused by the cog itself.
+
+        Input: Server ID, user ID and 'ban' or 'unban'
+        Output: True or False
+        """
+        expected = self.own_actions.pop((server_id, user_id), None)
+        return expected is not None and expected[0] == action and expected[1] >= time.monotonic()
+
+    @commands.Cog.listener()
+    async def on_member_ban(self, guild, user):
+        """
+        Keeps the ban cache up to date. In mirror mode, a ban done by hand
+        on a synced server is turned into a global ban.
+        """
+        self.bancache.add(guild.id, user.id)
+        if self.is_echo(guild.id, user.id, 'ban') or user.id in self.bans:
+            return
+        if await self.config.mirror() and guild.id in await self.config.synced_servers():
+            self.queue_mirror('ban', guild, user)
+
+    @commands.Cog.listener()
+    async def on_member_unban(self, guild, user):
+        """
+        Keeps the ban cache up to date. When someone who is globally banned gets
+        unbanned by hand on a synced server, mirror mode turns it into a global unban,
+        otherwise the server is marked as stale so the next sync bans them again.
+        """
+        self.bancache.discard(guild.id, user.id)
+        if self.is_echo(guild.id, user.id, 'unban') or user.id not in self.bans:
+            return
+        if guild.id in await self.config.synced_servers():
+            if await self.config.mirror():
+                self.queue_mirror('unban', guild, user)
+            else:
+                await self.mark_stale(guild.id)
+
+    def queue_mirror(self, action, guild, user):
+        """
+        Collects a ban or unban to mirror. They are applied after MIRROR_DELAY seconds,
+        so a wave of bans turns into one write and one outbox batch per server.
+        The last event for a user wins.
+
+        Input: 'ban' or 'unban', the server it happened on and the user
+        Output: Nothing
+        """
+        self.mirror_events[user.id] = (action, guild.id, guild.name, user.name)
+        if self.mirror_task is None or self.mirror_task.done():
+            self.mirror_task = self.bot.loop.create_task(self.mirror_later())
+
+    async def mirror_later(self):
+        await asyncio.sleep(MIRROR_DELAY)
+        await self.apply_mirror()
+
+    async def apply_mirror(self):
+        """
+        Turns the collected bans and unbans into global ones and puts them in the
+        outbox for every other synced server, one batch per server they came from.
+
+        Input: Nothing
+        Output: Nothing
+        """
+        await self.initiate
+        events, self.mirror_events = self.mirror_events, {}
+        bans, unbans = {}, {}
+        for user_id, (action, server_id, server_name, user_name) in events.items():
+            if action == 'ban' and user_id not in self.bans:
+                self.put_ban(GlobalBan(user_id, user_name, 'Banned on {}'.format(server_name), FOREVER_BANTIME, None))
+                bans.setdefault(server_id, []).append(user_id)
+            elif action == 'unban' and user_id in self.bans:
+                log.info('%s has been unbanned.', self.bans[user_id].name)
+                self.remove_bans(user_id)
+                unbans.setdefault(server_id, []).append(user_id)
+        if len(bans) == 0 and len(unbans) == 0:
+            return
+        await self.flush()
+        servers = await self.config.synced_servers()
+        for action, by_server in (('ban', bans), ('unban', unbans)):
+            for server_id, ids in by_server.items():
+                await self.store.enqueue_many(action, ids, [server for server in servers if server != server_id])
+        self.outbox_wakeup.set()
+        self.schedule_expiry()
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        """
+        Bans a globally banned user as soon as they join a synced server, instead of
+        waiting for the next sync. Everyone who is not banned is turned away by a single
+        dictionary lookup, so join raids cost no API calls or storage reads.
+        """
+        ban = self.bans.get(member.id)
+        if ban is None or ban.bantime <= time.time():
+            return
+        if member.guild.id not in await self.config.synced_servers():
+            return
+        try:
+            ban_member = functools.partial(member.guild.ban, member, reason='Global ban: {}'.format(ban.reason), delete_message_days=0)
+            self.expect_echo(member.guild.id, member.id, 'ban')
+            await self.ratelimiter.call(('ban', member.guild.id), ban_member)
+            self.bancache.add(member.guild.id, member.id)
+        except discord.errors.HTTPException:
+            log.warning('Could not ban %s (%s) who joined %s while globally banned.', member, member.id, member.guild.name)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        """
+        Drops the ban cache of a server the bot has left.
+        """
+        self.bancache.invalidate(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        """
+        Adds a server the bot joins to the synced list and applies the global bans to it, if autosync is on.
+        """
+        if not await self.config.auto_sync() or not self.owns_guild(guild.id):
+            return
+        await self.initiate
+        async with self.config.synced_servers() as servers:
+            if guild.id in servers:
+                return
+            servers.append(guild.id)
+        result = await self.onboard_guild(guild)
+        if result is not None and result['error'] is not None:
+            await self.report_failure([result['name']])
+
+    @has_permissions(ban_members=True)
+    @commands.command()
+    async def autosync(self, ctx, *, setting):
+        """
+        Turns adding every server the bot joins to the synced list on or off.
+
+        Input: CTX and on or off
+        Output: Nothing
+
+        Usage: [p]autosync <on/off>
+        """
+        setting = setting.lower()
+        if setting not in ('on', 'off'):
+            await ctx.send('Oops, please use on or off.')
+            return
+        await self.config.auto_sync.set(setting == 'on')
+        if setting == 'on':
+            await ctx.send('Every server I join will now be synced.')
+        else:
+            await ctx.send('Servers I join will no longer be synced automatically.')
+
+    @commands.is_owner()
+    @commands.command()
+    async def mirror(self, ctx, *, setting):
+        """
+        Turns mirror mode on or off. In mirror mode, banning or unbanning someone by hand
+        on a synced server bans or unbans them on every synced server.
+
+        Input: CTX and on or off
+        Output: Nothing
+
+        Usage: [p]mirror <on/off>
+        """
+        setting = setting.lower()
+        if setting not in ('on', 'off'):
+            await ctx.send('Oops, please use on or off.')
+            return
+        await self.config.mirror.set(setting == 'on')
+        if setting == 'on':
+            await ctx.send('Bans and unbans done on a synced server will now be applied to every synced server.')
+        else:
+            await ctx.send('Bans and unbans done on a synced server will no longer be mirrored.')
 
     @has_permissions(ban_members=True)
     @commands.command()
     async def bansync(self, ctx):
         """
-        Syncs all global bans across all servers.
+        Syncs all global bans across all servers, rescanning every server's ban list.
 
         Input: CTX
         Output: bansync_root
         """
-        await self.bansync_root()
+        await self.bansync_root(full=True, resume=False)
         await ctx.send('Done. If there is any error, the owner has been notified.')
 
+    @commands.is_owner()
+    @commands.command()
+    async def syncstats(self, ctx):
+        """
+        Shows how the syncs have been doing and which servers were the slowest.
+        The same numbers are written to metrics.prom in the cog's data folder.
+
+        Input: CTX
+        Output: A message with the sync metrics.
+        """
+        counters = self.metrics.counters
+        message = 'Sync metrics:\n'
+        message += '\nSyncs: {} ({} servers synced)'.format(counters['syncs'], counters['guild_syncs'])
+        message += '\nBans applied: {}'.format(counters['bans_applied'])
+        message += '\nRetries after 429s: {} ({:.1f} seconds waited)'.format(counters['retries'], counters['ratelimit_wait_seconds'])
+        message += '\nForbidden: {}'.format(counters['forbidden'])
+        message += '\nStopped on other API errors: {}'.format(counters['errors'])
+        if self.metrics.last_sync is not None:
+            message += '\nLast sync: {:.1f} seconds for {} servers'.format(self.metrics.last_sync['seconds'], self.metrics.last_sync['guilds'])
+            message += '\n\nSlowest servers of their last sync:'
+            for number, stats in enumerate(self.metrics.slowest()):
+                fetch = 'cached' if stats['fetch_seconds'] is None else '{:.1f}s'.format(stats['fetch_seconds'])
+                message += '\n{}. {} - {:.1f}s (fetch: {}, banned: {}, retries: {})'.format(
+                    number + 1, stats['name'], stats['seconds'], fetch, stats['banned'], stats['retries']
+                )
+        await ctx.send(message)
+
+    @commands.is_owner()
+    @commands.command()
+    async def slowguild(self, ctx, seconds: float):
+        """
+        Logs every server whose sync takes longer than this many seconds. Use 0 to turn it off.
+
+        Input: CTX and seconds
+        Output: Nothing
+
+        Usage: [p]slowguild <seconds>
+        """
+        await self.config.slow_guild_seconds.set(max(seconds, 0))
+        if seconds > 0:
+            await ctx.send('Servers that take longer than {} seconds to sync will be logged.'.format(seconds))
+        else:
+            await ctx.send('Slow servers will no longer be logged.')
+
+    @commands.is_owner()
+    @commands.command()
+    async def banstorage(self, ctx, *, path=None):
+        """
+        Sets the SQLite file the global bans are kept in. Point every process of a
+        sharded bot at the same file so they share their bans and outbox.
+        Leave the path out to go back to the file in the cog's data folder.
+
+        The switch happens straight away. The waiting outbox entries always move along.
+        The bans are copied into a new file or back into the cog's own file. A shared file
+        that already has bans keeps its own and only gets the ones it is missing. Every server is rescanned on its next
+        sync, as the revisions of the two files do not match.
+
+        Input: CTX and path
+        Output: Nothing
+
+        Usage: [p]banstorage [path]
+        """
+        try:
+            target = SQLiteBanStore(path or cog_data_path(self) / 'bans.sqlite3')
+        except sqlite3.Error:
+            await ctx.send('I could not open that file. Please check the path.')
+            return
+        if os.path.abspath(target.path) == os.path.abspath(self.store.path):
+            target.close()
+            await ctx.send('The bans are already kept in that file.')
+            return
+        async with self.sync_lock:
+            self.outbox.cancel()
+            self.tempbans.cancel()
+            await self.flush()
+            async with self.flush_lock:
+                try:
+                    copied, moved = await move_store(self.store, target, replace=path is None)
+                except sqlite3.Error:
+                    target.close()
+                    self.outbox = self.bot.loop.create_task(self.run_outbox())
+                    self.tempbans = self.bot.loop.create_task(self.checktempbans())
+                    await ctx.send('I could not move the bans to that file. Nothing has been changed.')
+                    return
+                old, self.store = self.store, target
+                self.seen_revision = await self.store.revision()
+                self.bans = BanIndex((await self.store.all()).values())
+            old.close()
+            await self.config.storage_path.set(path)
+            await self.config.watermarks.set({})
+            self.expiry_heap = []
+            self.outbox = self.bot.loop.create_task(self.run_outbox())
+            self.tempbans = self.bot.loop.create_task(self.checktempbans())
+        await ctx.send('The ban storage has been changed. {} outbox entries were moved and {} bans were copied, {} global bans in total.'.format(moved, copied, len(self.bans)))
+
     async def checktempbans(self):
-        async with self.config.global_bans() as banned_users:
-            async with self.config.synced_servers() as servers:
-                while True:
-                    for id, member in banned_users.items():
-                        if member[2] < time.mktime(datetime.now().timetuple()):
-                            for server in servers:
-                                server = self.bot.get_guild(server)
-                                if server is None:
-                                    del servers[servers.index(server)]
-                                    continue
-                                try:
-                                    print(banned_users)
-                                    await server.unban(discord.Object(id=int(id)))
-                                    del (banned_users[id])
-                                    print('{} has been unbanned.'.format(member[0]))
-                                except:
-                                    pass
-                    await asyncio.sleep(60)
+        """
+        Unbans temporarily banned users when their ban runs out.
 
+        The expiry times are kept in a min-heap, so the task sleeps until the
+        next ban ends instead of checking every ban each minute. globalban and
+        globalunban wake it up through schedule_expiry. Bans that end at the
+        same moment are lifted together.
 
+        When the bot is split over several processes, only the one running shard 0
+        lifts tempbans. The others see the bans go through pull_changes.
+        If lifting a batch fails, the error is logged and the batch is tried again later.
 
+        Input: Nothing
+        Output: Nothing
+        """
+        await self.initiate
+        if not self.is_leader():
+            return
+        self.expiry_heap = [(ban.bantime, ban.user_id) for ban in self.bans.values() if not ban.forever]
+        heapq.heapify(self.expiry_heap)
+        while True:
+            try:
+                await self.expiry_pass()
+            except Exception:
+                log.exception('Lifting tempbans failed.')
+                await asyncio.sleep(OUTBOX_BACKOFF)
 
+    async def expiry_pass(self):
+        """
+        Lifts the tempbans that have ended, or sleeps until the next one ends.
+
+        Input: Nothing
+        Output: Nothing, raises the error if the bans could not be lifted, after putting them back in the heap
+        """
+        self.expiry_wakeup.clear()
+        if len(self.expiry_heap) == 0:
+            await self.expiry_wakeup.wait()
+            return
+        delay = self.expiry_heap[0][0] - time.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(self.expiry_wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            return
+        now = time.time()
+        expired = []
+        while len(self.expiry_heap) > 0 and self.expiry_heap[0][0] <= now:
+            expired.append(heapq.heappop(self.expiry_heap))
+        try:
+            await self.expire_bans(expired)
+        except Exception:
+            for entry in expired:
+                heapq.heappush(self.expiry_heap, entry)
+            raise
+
+    def schedule_expiry(self, id=None, bantime=None):
+        """
+        Adds a temporary ban to the expiry heap and wakes up checktempbans.
+        Removed bans are left in the heap and skipped when they come up.
+        Only the leader lifts tempbans, so on other processes this does nothing.
+
+        Input: ID and the time the ban ends, or nothing to only wake the task up
+        Output: Nothing
+        """
+        if not self.is_leader():
+            return
+        if id is not None:
+            heapq.heappush(self.expiry_heap, (bantime, int(id)))
+        self.expiry_wakeup.set()
+
+    async def expire_bans(self, expired):
+        """
+        Removes a batch of temporary bans that have ended and puts their unbans
+        for every synced server in the outbox, in one write. The unbans are saved
+        before the bans are removed, so a failed write leaves the bans to be tried again.
+
+        Input: List of (bantime, ID) popped from the expiry heap
+        Output: Nothing
+        """
+        ids = list(dict.fromkeys(id for bantime, id in expired if id in self.bans and self.bans[id].bantime == bantime))
+        if len(ids) == 0:
+            return
+        bans = {id: self.bans[id] for id in ids}
+        servers = await self.config.synced_servers()
+        await self.store.enqueue_many('unban', ids, servers)
+        # A ban changed by globalban in the meantime stays.
+        ids = [id for id in ids if self.bans.get(id) is bans[id]]
+        for id in ids:
+            log.info('%s has been unbanned.', self.bans[id].name)
+        self.remove_bans(*ids)
+        self.outbox_wakeup.set()
+        await self.flush()
+
+    async def run_outbox(self):
+        """
+        Applies the bans and unbans waiting in the outbox.
+
+        globalban, globalunban and expiring tempbans only save what has to happen on
+        which server. This task does the work, up to sync_concurrency servers at a time,
+        and retries failed entries with exponential backoff until they go through or
+        OUTBOX_MAX_ATTEMPTS is reached. When the bot is split over several processes,
+        each one only applies the entries of the servers on its own shards.
+        An error in one pass is logged and the outbox carries on.
+
+        Input: Nothing
+        Output: Nothing
+        """
+        await self.initiate
+        while True:
+            try:
+                await self.outbox_pass()
+            except Exception:
+                log.exception('Applying the outbox failed.')
+                await asyncio.sleep(OUTBOX_BACKOFF)
+
+    async def outbox_pass(self):
+        """
+        Applies one batch of due outbox entries, or waits until one is due.
+
+        Input: Nothing
+        Output: Nothing
+        """
+        self.outbox_wakeup.clear()
+        entries = await self.store.due(time.time(), OUTBOX_BATCH, self.shards())
+        if len(entries) == 0:
+            next_due = await self.store.next_due(self.shards())
+            timeout = None if next_due is None else max(next_due - time.time(), 0)
+            if self.shards() is not None:
+                # Other processes can queue entries for this process' servers without waking it up.
+                timeout = COORDINATION_INTERVAL if timeout is None else min(timeout, COORDINATION_INTERVAL)
+            try:
+                await asyncio.wait_for(self.outbox_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            return
+        by_server = {}
+        for entry in entries:
+            by_server.setdefault(entry[0], []).append(entry)
+        semaphore = asyncio.Semaphore(self.sync_concurrency)
+        results = await asyncio.gather(*[self.apply_outbox(server, entries, semaphore) for server, entries in by_server.items()], return_exceptions=True)
+        for server, result in zip(by_server, results):
+            if isinstance(result, Exception):
+                log.error('Applying the outbox of %s failed.', server, exc_info=result)
+        failed_servers = [name for name in results if isinstance(name, str)]
+        if len(failed_servers) > 0:
+            await self.report_failure(failed_servers)
+
+    async def apply_outbox(self, server_id, entries, semaphore):
+        """
+        Applies the outbox entries of one server.
+        An entry that fails for any reason, not only an HTTP error, is retried later.
+
+        Input: Server ID, its due outbox entries and the semaphore limiting how many servers are worked on at once
+        Output: The server's name if some entries were given up on, otherwise None
+        """
+        server = self.bot.get_guild(server_id)
+        if server is None:
+            await self.store.complete([(server_id, user_id, action) for server_id, user_id, action, attempts in entries])
+            return None
+        done, retry, given_up = [], [], False
+        async with semaphore:
+            if self.bancache.peek(server.id) is None and sum(1 for entry in entries if entry[2] == 'ban') >= OUTBOX_FETCH_BANS:
+                try:
+                    await self.bancache.get(server, self.fetch_ban_ids)
+                except (discord.errors.HTTPException, asyncio.TimeoutError):
+                    pass
+            for number, (server_id, user_id, action, attempts) in enumerate(entries):
+                try:
+                    if action == 'ban':
+                        if user_id not in (self.bancache.peek(server.id) or ()):
+                            ban = functools.partial(server.ban, discord.Object(id=user_id), delete_message_days=0)
+                            self.expect_echo(server.id, user_id, 'ban')
+                            await self.ratelimiter.call(('ban', server.id), ban)
+                            self.bancache.add(server.id, user_id)
+                    else:
+                        unban = functools.partial(server.unban, discord.Object(id=user_id))
+                        self.expect_echo(server.id, user_id, 'unban')
+                        await self.ratelimiter.call(('ban', server.id), unban)
+                        self.bancache.discard(server.id, user_id)
+                    done.append((server_id, user_id, action))
+                except discord.errors.NotFound:
+                    done.append((server_id, user_id, action))
+                except Exception as ex:
+                    if not isinstance(ex, discord.errors.HTTPException):
+                        log.warning('Applying the %s of %s on %s failed: %r', action, user_id, server_id, ex)
+                    failed = entries[number:] if isinstance(ex, discord.errors.Forbidden) else [entries[number]]
+                    for failed_server, failed_user, failed_action, failed_attempts in failed:
+                        if failed_attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                            done.append((failed_server, failed_user, failed_action))
+                            given_up = True
+                        else:
+                            next_attempt = time.time() + min(OUTBOX_BACKOFF * 2 ** failed_attempts, 60 * 60)
+                            retry.append((failed_server, failed_user, failed_action, failed_attempts + 1, next_attempt))
+                    if isinstance(ex, discord.errors.Forbidden):
+                        break
+        await self.store.complete(done)
+        await self.store.retry(retry)
+        return server.name if given_up else None
+
+    @commands.is_owner()
     @commands.command()
-    async def globalbans(self, ctx):
+    async def exportbans(self, ctx, format='jsonl'):
         """
-        Shows all the global bans.
+        Sends every global ban as a JSON lines or CSV file, e.g. as a backup or for another bot.
 
-        Input: CTX
-        Output: Shows everyone who is banned throughout all servers
+        Input: CTX and the format
+        Output: A message with the file.
+
+        Usage: [p]exportbans [jsonl/csv]
+        """
+        format = format.lower()
+        if format not in FORMATS:
+            await ctx.send('Oops, please use jsonl or csv.')
+            return
+        await self.flush()
+        path = cog_data_path(self) / 'globalbans.{}'.format(format)
+        with open(str(path), 'w', newline='', encoding='utf-8') as file:
+            count = write_bans(self.bans.values(), file, format)
+        await ctx.send('Here are all {} global bans.'.format(count), file=discord.File(str(path)))
+
+    @commands.is_owner()
+    @commands.command()
+    async def importbans(self, ctx, format=None):
         """
-        message = 'Here are the globally banned users:\n'
-        async with self.config.global_bans() as banned_users:
-            for number, user in enumerate(banned_users.values()):
-                message += '\n{}. {} - Reason: {} - Time: {}'.format(number + 1, user[0], user[1], user[3])
-            if len(banned_users.keys()) == 0:
-                message += '\nNone'
-            await ctx.send(message)
+        Adds the global bans in the attached JSON lines or CSV file, like the ones exportbans makes.
+        Bans already in the list are updated. The new ones are applied to every synced server.
+
+        Input: CTX and the format, taken from the file name if it is left out
+        Output: A message with how many bans were imported and which lines were wrong.
+
+        Usage: [p]importbans [jsonl/csv] (with the file attached)
+        """
+        if len(ctx.message.attachments) == 0:
+            await ctx.send('Please attach the file with the bans.')
+            return
+        attachment = ctx.message.attachments[0]
+        format = (format or attachment.filename.rsplit('.', 1)[-1]).lower()
+        if format not in FORMATS:
+            await ctx.send('Oops, please use jsonl or csv.')
+            return
+        path = cog_data_path(self) / 'import.{}'.format(format)
+        await attachment.save(str(path))
+        try:
+            imported, new, errors = await self.import_bans(path, format)
+        except sqlite3.Error:
+            log.exception('Importing bans failed.')
+            await ctx.send('Oops, the bans could not be saved, so none were imported.')
+            return
+        finally:
+            path.unlink()
+        servers = await self.config.synced_servers()
+        message = '{} bans have been imported, {} of them new. The new bans are being applied to {} connected servers.'.format(imported, new, len(servers))
+        if len(errors) > 0:
+            message += '\n\n{} lines were skipped:'.format(len(errors))
+            for error in errors[:10]:
+                message += '\n{}'.format(error)
+            if len(errors) > 10:
+                message += '\n...'
+        await ctx.send(message)
+
+    async def import_bans(self, path, format):
+        """
+        Reads a file of bans and adds them to the global bans in one write. The users who
+        were not banned yet are put in the outbox for every synced server in one go, so
+        the bans are applied to each server in batches.
+
+        Input: Path of the file and 'jsonl' or 'csv'
+        Output: (how many bans were imported, how many of them are new, list of errors)
+        """
+        bans, errors = {}, []
+        with open(str(path), newline='', encoding='utf-8') as file:
+            for line, ban, error in read_bans(file, format):
+                if ban is None:
+                    errors.append('Line {}: {}'.format(line, error))
+                else:
+                    bans[ban.user_id] = ban
+        if len(bans) == 0:
+            return 0, 0, errors
+        await self.flush()
+        new = [id for id in bans if id not in self.bans]
+        await self.store.upsert_many(list(bans.values()))
+        for ban in bans.values():
+            self.bans.put(ban)
+            if not ban.forever:
+                self.schedule_expiry(ban.user_id, ban.bantime)
+        if len(new) > 0:
+            await self.store.enqueue_many('ban', new, await self.config.synced_servers())
+            self.outbox_wakeup.set()
+        return len(bans), len(new), errors
+
+    @commands.command()
+    async def globalbans(self, ctx, page: Optional[int] = 1, *, filters=''):
+        """
+        Shows the global bans, one page at a time.
+
+        The bans are sorted by name. They can be filtered with name:<text>, reason:<text>,
+        before:<time> (ends within that time) and after:<time> (ends later than that time),
+        where time is written like in globalban, e.g. 1W-2D. The page number can be left out.
+
+        Input: CTX, page number and filters
+        Output: Shows one page of everyone who is banned throughout all servers
+
+        Usage: [p]globalbans [page] [name:<text>] [reason:<text>] [before:<time>] [after:<time>]
+        """
+        search = {'name': None, 'reason': None, 'ends_after': None, 'ends_before': None}
+        try:
+            for word in shlex.split(filters):
+                key, _, value = word.partition(':')
+                key = key.lower()
+                if key in ('name', 'reason'):
+                    search[key] = value
+                elif key in ('before', 'after'):
+                    seconds, errors = parse_duration(value)
+                    if len(errors) > 0:
+                        raise ValueError(value)
+                    search['ends_' + key] = time.time() + seconds
+                else:
+                    raise ValueError(word)
+        except ValueError:
+            await ctx.send('Oops, please use name:<text>, reason:<text>, before:<time> or after:<time>.')
+            return
+
+        page = max(page or 1, 1)
+        bans, more = self.bans.page(page, BANS_PER_PAGE, **search)
+        if any(value is not None for value in search.values()):
+            message = 'Here are the globally banned users (page {}):\n'.format(page)
+        else:
+            pages = max(1, -(-len(self.bans) // BANS_PER_PAGE))
+            message = 'Here are the globally banned users (page {} of {}):\n'.format(page, pages)
+        for number, ban in enumerate(bans, start=(page - 1) * BANS_PER_PAGE + 1):
+            line = '{}. {} - Reason: {} - Time: {}'.format(number, ban.name[:NAME_LENGTH], ban.reason[:REASON_LENGTH], ban.bantime_string)
+            message += '\n' + line[:LINE_LENGTH]
+        if len(bans) == 0:
+            message += '\nNone'
+        elif more:
+            message += '\n\nUse {}globalbans {} to see the next page.'.format(ctx.prefix, page + 1)
+        await ctx.send(message)
 
     @has_permissions(ban_members=True)
     @commands.command()
@@ -230,27 +1468,7 @@ class BanSync(commands.Cog):
                 reason = 'Not Given'
             rawbantime = time_of_ban
             if rawbantime is not '/':
-                keycodes = {'Y': 365, 'M': 30, 'W': 7, 'D': 1, 'H': 1, 'M': 1, 'S': 1}
-
-                total = {'D': 0, 'H': 0, 'M': 0, 'S': 0}
-
-                process_errors = []
-
-                processed_string = rawbantime.split('-')
-
-                for i in processed_string:
-                    number = int(''.join(list(filter(lambda x: x.isdigit(), i))))
-                    keycode = (''.join(list(filter(lambda x: x.isalpha(), i)))).upper()
-
-                    try:
-                        number = number * keycodes[keycode]
-                        if keycode in ['Y', 'MM', 'W']:
-                            keycode = 'D'
-                        total[keycode] += number
-                    except KeyError:
-                        process_errors.append(keycode)
-                    except:
-                        ctx.send('Something went wrong, but im not sure what. Please check how to use the command.')
+                duration, process_errors = parse_duration(rawbantime)
 
                 if len(process_errors) is not 0:
                     error_string = ''
@@ -266,67 +1484,25 @@ class BanSync(commands.Cog):
                     print("I don't have these keycode(s): {}. Please check how to use the command.".format(error_string))
                     return True
 
-                bantime_string = ''
-
-                for timestamp, value in total.items():
-                    if value is not 0:
-                        last_value = timestamp
-
-                for rawtimestamp, amount in total.items():
-                    if rawtimestamp is 'D':
-                        timestamp = 'days' if amount > 1 else 'day'
-                    if rawtimestamp is 'H':
-                        timestamp = 'hours' if amount > 1 else 'hour'
-                    if rawtimestamp is 'M':
-                        timestamp = 'minutes' if amount > 1 else 'minute'
-                    if rawtimestamp is 'S':
-                        timestamp = 'seconds' if amount > 1 else 'second'
-                    if amount > 0:
-                        if len(bantime_string) is 0:
-                            bantime_string += '{} {}'.format(amount, timestamp)
-                        elif rawtimestamp == last_value:
-                            bantime_string += ' and {} {}'.format(amount, timestamp)
-                        else:
-                            bantime_string += ', {} {}'.format(amount, timestamp)
-
-                bantime = time.mktime(datetime.now().timetuple()) + timedelta(days=total['D'], hours=total['H'], minutes=total['M'], seconds=total['S']).total_seconds()
+                bantime = time.mktime(datetime.now().timetuple()) + duration
             else:
-                bantime = timedelta(days=100).total_seconds() * 1000000
-                bantime_string = 'Forever'
+                bantime = FOREVER_BANTIME
+                duration = None
+            ban = GlobalBan(member.id, member.name, reason, bantime, duration)
 
             if member is not 0:
-                async with self.config.synced_servers() as servers:
-                    failed_servers = []
-                    successful = 0
-                    for server in servers:
-                        server = self.bot.get_guild(server)
-                        if server is None:
-                            del servers[servers.index(server)]
-                            continue
-                        try:
-                            bans = [b.user for b in await server.bans()]
-                            if member not in bans:
-                                await member.send('You have been banned from all {} servers for {} because of the reason: {}.'.format('Gaming For Life', bantime_string, reason))
-                                await server.ban(member, delete_message_days=0)
-                                successful += 1
-                                print('before')
-                                print('after')
-                            else:
-                                pass
-                        except discord.errors.Forbidden:
-                            failed_servers.append(server.name)
-                    async with self.config.global_bans() as global_bans:
-                        if len(failed_servers) is 0:
-                            global_bans.update({member.id: [member.name, reason, bantime, bantime_string]})
-                    if successful is len(servers):
-                        await ctx.send('%s has been banned from all connected servers.' % member.name)
-                    elif successful > 0 and successful < len(servers):
-                        await ctx.send('%s has been banned from some of the connected servers.' % member.name)
-                    else:
-                        await ctx.send('We have not been able to ban %s from the connected servers.' % member.name)
-
-                    if len(failed_servers) > 0:
-                        await self.report_failure(failed_servers)
+                servers = await self.config.synced_servers()
+                try:
+                    await member.send('You have been banned from all {} servers for {} because of the reason: {}.'.format('Gaming For Life', ban.bantime_string, reason))
+                except discord.errors.HTTPException:
+                    pass
+                self.put_ban(ban)
+                await self.flush()
+                await self.store.enqueue('ban', ban.user_id, servers)
+                self.outbox_wakeup.set()
+                if not ban.forever:
+                    self.schedule_expiry(ban.user_id, ban.bantime)
+                await ctx.send('{} has been globally banned. The ban is being applied to {} connected servers.'.format(member.name, len(servers)))
             if member is None:
                 await ctx.send('It seems like %s is not connected to any of the servers I manage. :(' % member.name)
 
@@ -346,39 +1522,18 @@ class BanSync(commands.Cog):
         Usage: [p]globalunban <id>
         """
         try:
-            failed_servers = []
-            successful = 0
-            async with self.config.global_bans() as banned_users:
-                if id in list(banned_users.keys()):
-                    async with self.config.synced_servers() as servers:
-                        for server in servers:
-                            server = self.bot.get_guild(server)
-                            if server is None:
-                                del servers[servers.index(server)]
-                                continue
-                            try:
-                                await server.unban(discord.Object(id=int(id)))
-                                successful += 1
-                            except discord.errors.Forbidden:
-                                failed_servers.append(server.name)
-                        if successful is len(servers):
-                            await ctx.send('%s has been unbanned from all connected servers.' % banned_users[id][0])
-                        elif successful > 0 and successful < servers:
-                            await ctx.send('%s has been unbanned from some of the connected servers.' % banned_users[id][0])
-                        else:
-                            await ctx.send('We have not been able to unban %s from the connected servers.' % banned_users[id][0])
-                        if len(failed_servers) is 0:
-                            del(banned_users[id])
-                            return True
-                if len(failed_servers) > 0:
-                    await self.report_failure(failed_servers)
-                if banned_users[id] is None:
-                    # This will call the KeyError exception to tell the user that the ID is wrong.
-                    pass
-                if type(id) is not int:
-                    await ctx.send("This command requires the user's id")
-                if id is 0:
-                    await ctx.send('Please enter an ID. \nThis command is used like this: --globalunban <ID>.')
+            banned_user = self.bans.get(int(id))
+            if banned_user is None:
+                # This will call the KeyError exception to tell the user that the ID is wrong.
+                raise KeyError(id)
+            servers = await self.config.synced_servers()
+            self.remove_bans(banned_user.user_id)
+            await self.flush()
+            await self.store.enqueue('unban', banned_user.user_id, servers)
+            self.outbox_wakeup.set()
+            self.schedule_expiry()
+            await ctx.send('{} has been globally unbanned. The unban is being applied to {} connected servers.'.format(banned_user.name, len(servers)))
+            return True
         except KeyError:
             await ctx.send('This user may not actually be banned or the ID is wrong')
         except:
@@ -408,7 +1563,7 @@ class BanSync(commands.Cog):
     async def sync(self, ctx, *, id):
         """
         Adds a server to the synced list if it is not already there.
-        Then it re-syncs the global bans.
+        Then it applies the global bans to that server only, showing how far it is.
 
         Input: CTX and ID
         Output: Nothing
@@ -420,14 +1575,30 @@ class BanSync(commands.Cog):
             server = self.bot.get_guild(id)
             async with self.config.synced_servers() as servers:
                 if server is not None:
-                    if server not in servers:
+                    if server.id not in servers:
                         servers.append(server.id)
-                        await ctx.send('The server, {}, has been added to the synced server list. Give me a moment while I sync all the global bans to its server.'.format(server.name))
-                        await self.bansync_root()
+                        added = True
                     else:
                         await ctx.send('This server is already in the synced list.')
+                        added = False
                 else:
                     await ctx.send('This server does not exist or I am not connected to it. Please enter a valid server ID.')
+                    added = False
+            if added:
+                message = await ctx.send('The server, {}, has been added to the synced server list. Give me a moment while I sync all the global bans to its server.'.format(server.name))
+
+                async def progress(done, total):
+                    await message.edit(content='Syncing the global bans to {}: {} of {} bans applied.'.format(server.name, done, total))
+
+                result = await self.onboard_guild(server, progress)
+                if result is None or result['forbidden']:
+                    await ctx.send('I could not ban on {}. Check if I am admin or if I can ban other players there.'.format(server.name))
+                elif result['error'] is not None:
+                    await ctx.send('Discord gave an error while syncing {} ({}). {} bans were applied, the next sync will try again.'.format(
+                        server.name, result['error'], result['banned']
+                    ))
+                else:
+                    await ctx.send('Done. {} bans have been applied to {}.'.format(result['banned'], server.name))
         except ValueError:
             await ctx.send('The ID must be a number.')
         except:
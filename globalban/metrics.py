@@ -0,0 +1,142 @@
+import os
+import time
+
+# Upper bounds, in seconds, of the histogram buckets.
+BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class Histogram:
+    """
+    Counts how many observations fall under each bucket, like a Prometheus histogram.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for number, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[number] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_prometheus(self, name, description):
+        lines = ['# HELP {} {}'.format(name, description), '# TYPE {} histogram'.format(name)]
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, count))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, self.count))
+        lines.append('{}_sum {}'.format(name, self.sum))
+        lines.append('{}_count {}'.format(name, self.count))
+        return lines
+
+
+class SyncMetrics:
+    """
+    Collects how long syncs take and what they did, per server and in total.
+
+    Counters and histograms add up over the life of the cog. The per server
+    numbers are those of the last sync that server was part of.
+    """
+
+    COUNTERS = {
+        'syncs': 'Number of syncs that have run.',
+        'guild_syncs': 'Number of times a server has been synced.',
+        'bans_applied': 'Number of bans the syncs have applied.',
+        'retries': 'Number of requests retried after a 429.',
+        'ratelimit_wait_seconds': 'Seconds spent waiting because of 429s.',
+        'forbidden': 'Number of times a server refused a sync.',
+        'errors': 'Number of times a server sync stopped on another API error.',
+    }
+
+    def __init__(self):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.sync_seconds = Histogram()
+        self.guild_seconds = Histogram()
+        self.fetch_seconds = Histogram()
+        self.guilds = {}
+        self.last_sync = None
+        self._pending = {}
+
+    def ratelimited(self, route, retry_after, is_global):
+        """
+        Records a 429. Used as the RateLimiter's on_429 callback.
+
+        Input: Route key, seconds to wait and whether the limit was global
+        Output: Nothing
+        """
+        self.counters['retries'] += 1
+        self.counters['ratelimit_wait_seconds'] += retry_after
+        stats = self._pending.setdefault(route[1], {'retries': 0, 'wait_seconds': 0.0})
+        stats['retries'] += 1
+        stats['wait_seconds'] += retry_after
+
+    def record_sync(self, results, seconds):
+        """
+        Records a finished sync.
+
+        Input: The per server results of sync_guild and how long the whole sync took
+        Output: Nothing
+        """
+        self.counters['syncs'] += 1
+        self.sync_seconds.observe(seconds)
+        self.last_sync = {'finished': time.time(), 'seconds': seconds, 'guilds': 0}
+        for result in results:
+            if result is None:
+                continue
+            stats = self._pending.pop(result['id'], {'retries': 0, 'wait_seconds': 0.0})
+            stats.update(result)
+            self.guilds[result['id']] = stats
+            self.counters['guild_syncs'] += 1
+            self.counters['bans_applied'] += result['banned']
+            self.counters['forbidden'] += 1 if result['forbidden'] else 0
+            self.counters['errors'] += 1 if result['error'] is not None and not result['forbidden'] else 0
+            self.guild_seconds.observe(result['seconds'])
+            if result['fetch_seconds'] is not None:
+                self.fetch_seconds.observe(result['fetch_seconds'])
+            self.last_sync['guilds'] += 1
+        self._pending.clear()
+
+    def slowest(self, count=5):
+        """
+        Output: The per server numbers of the slowest servers of their last sync
+        """
+        return sorted(self.guilds.values(), key=lambda stats: stats['seconds'], reverse=True)[:count]
+
+    def to_prometheus(self):
+        """
+        Output: Every metric in the Prometheus text format
+        """
+        lines = []
+        for name, description in self.COUNTERS.items():
+            metric = 'globalban_{}_total'.format(name)
+            lines += ['# HELP {} {}'.format(metric, description), '# TYPE {} counter'.format(metric)]
+            lines.append('{} {}'.format(metric, self.counters[name]))
+        lines += self.sync_seconds.to_prometheus('globalban_sync_seconds', 'Seconds a whole sync took.')
+        lines += self.guild_seconds.to_prometheus('globalban_guild_sync_seconds', 'Seconds syncing one server took.')
+        lines += self.fetch_seconds.to_prometheus('globalban_guild_fetch_seconds', "Seconds fetching one server's ban list took.")
+        for name, description in (
+            ('seconds', 'Seconds the last sync of the server took.'),
+            ('banned', 'Bans applied by the last sync of the server.'),
+            ('retries', 'Requests retried after a 429 in the last sync of the server.'),
+            ('wait_seconds', 'Seconds waited on 429s in the last sync of the server.'),
+        ):
+            metric = 'globalban_guild_last_{}'.format(name)
+            lines += ['# HELP {} {}'.format(metric, description), '# TYPE {} gauge'.format(metric)]
+            for id, stats in self.guilds.items():
+                lines.append('{}{{guild="{}"}} {}'.format(metric, id, stats[name]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics to a file, replacing it in one step so readers never see half a file.
+
+        Input: Path of the file
+        Output: Nothing
+        """
+        temporary = '{}.tmp'.format(path)
+        with open(temporary, 'w') as file:
+            file.write(self.to_prometheus())
+        os.replace(temporary, str(path))
@@ -0,0 +1,98 @@
+import asyncio
+
+import discord
+
+
+class RateLimiter:
+    """
+    Paces requests to Discord so that many guilds can be synced at once.
+
+    Discord has one global bucket for the whole bot and a bucket per route.
+    The ban routes are bucketed on the guild id, so a 429 on one guild only
+    pauses that guild while every other guild keeps going. A global 429
+    pauses everything.
+
+    Usage: await limiter.call(('ban', guild.id), functools.partial(guild.ban, user))
+    """
+
+    def __init__(self, per_second=50, retries=5, on_429=None):
+        """
+        Input: The number of requests allowed per second, how many times a 429 is retried
+               and optionally a function called with (route, retry_after, is_global) on every 429
+        Output: Nothing
+        """
+        self.per_second = per_second
+        self.retries = retries
+        self.on_429 = on_429
+        self._next_slot = 0.0
+        self._global_reset = 0.0
+        self._routes = {}
+
+    async def acquire(self, route):
+        """
+        Waits until both the global bucket and the route's bucket allow another request.
+
+        Input: Route key
+        Output: Nothing
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            now = loop.time()
+            wait_until = max(self._global_reset, self._routes.get(route, 0.0))
+            if wait_until <= now:
+                break
+            await asyncio.sleep(wait_until - now)
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / self.per_second
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def backoff(self, route, retry_after, is_global=False):
+        """
+        Marks a bucket as exhausted for retry_after seconds.
+
+        Input: Route key, seconds to wait and whether the 429 was global
+        Output: Nothing
+        """
+        reset = asyncio.get_event_loop().time() + retry_after
+        if is_global:
+            self._global_reset = max(self._global_reset, reset)
+        else:
+            self._routes[route] = max(self._routes.get(route, 0.0), reset)
+
+    async def call(self, route, request):
+        """
+        Runs a request inside the rate limits, backing off and retrying on 429s.
+
+        Input: Route key and a function that returns the request's coroutine
+        Output: Whatever the request returns
+        """
+        attempt = 0
+        while True:
+            await self.acquire(route)
+            try:
+                return await request()
+            except discord.errors.HTTPException as ex:
+                if ex.status != 429 or attempt >= self.retries:
+                    raise
+                attempt += 1
+                retry_after, is_global = self.parse_429(ex, attempt)
+                self.backoff(route, retry_after, is_global)
+                if self.on_429 is not None:
+                    self.on_429(route, retry_after, is_global)
+
+    @staticmethod
+    def parse_429(ex, attempt):
+        """
+        Reads how long to wait from a 429 response.
+
+        Input: The HTTPException and the attempt number
+        Output: (seconds to wait, whether the limit is global)
+        """
+        headers = getattr(ex.response, 'headers', None) or {}
+        try:
+            retry_after = float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            retry_after = 2 ** attempt
+        is_global = str(headers.get('X-RateLimit-Global', '')).lower() == 'true'
+        return retry_after, is_global
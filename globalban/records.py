@@ -0,0 +1,102 @@
+import re
+
+UNITS = [('day', 24 * 60 * 60), ('hour', 60 * 60), ('minute', 60), ('second', 1)]
+
+# The keycodes used when writing a ban time, like 1W-2D-3H.
+KEYCODES = {'Y': 365 * 24 * 60 * 60, 'W': 7 * 24 * 60 * 60, 'D': 24 * 60 * 60, 'H': 60 * 60, 'M': 60, 'S': 1}
+
+# Bans that last forever are stored with a bantime no one will ever reach.
+FOREVER_BANTIME = 100 * 24 * 60 * 60 * 1000000
+
+
+def format_duration(seconds):
+    """
+    Turns a number of seconds into text like '1 day, 2 hours and 3 minutes'.
+
+    Input: Seconds, or None for a ban that lasts forever
+    Output: The duration as text
+    """
+    if seconds is None:
+        return 'Forever'
+    parts = []
+    seconds = int(seconds)
+    for unit, length in UNITS:
+        amount, seconds = divmod(seconds, length)
+        if amount > 0:
+            parts.append('{} {}'.format(amount, unit + 's' if amount > 1 else unit))
+    if len(parts) == 0:
+        return '0 seconds'
+    if len(parts) == 1:
+        return parts[0]
+    return ', '.join(parts[:-1]) + ' and ' + parts[-1]
+
+
+def parse_duration(text):
+    """
+    Reads a ban time written with keycodes, like 1W-2D-3H.
+
+    Input: The ban time
+    Output: (seconds, list of keycodes that do not exist)
+    """
+    seconds = 0
+    errors = []
+    for part in text.split('-'):
+        number = int(''.join(filter(lambda x: x.isdigit(), part)))
+        keycode = ''.join(filter(lambda x: x.isalpha(), part)).upper()
+        if keycode in KEYCODES:
+            seconds += number * KEYCODES[keycode]
+        else:
+            errors.append(keycode)
+    return seconds, errors
+
+
+def parse_duration_string(text):
+    """
+    Reads a duration written by format_duration, or by older versions of the cog, back into seconds.
+
+    Input: The duration as text
+    Output: Seconds, or None for 'Forever'
+    """
+    if text == 'Forever':
+        return None
+    lengths = dict(UNITS)
+    return sum(int(amount) * lengths[unit] for amount, unit in re.findall(r'(\d+) (day|hour|minute|second)', text))
+
+
+class GlobalBan:
+    """
+    One global ban.
+
+    The text shown for how long the ban lasts is only built when it is needed.
+    """
+
+    __slots__ = ('user_id', 'name', 'reason', 'bantime', 'duration')
+
+    def __init__(self, user_id, name, reason, bantime, duration):
+        """
+        Input: User ID, name, reason, the time the ban ends and how long it lasts in seconds (None for forever)
+        Output: Nothing
+        """
+        self.user_id = int(user_id)
+        self.name = name
+        self.reason = reason
+        self.bantime = bantime
+        self.duration = duration
+
+    @property
+    def forever(self):
+        return self.duration is None
+
+    @property
+    def bantime_string(self):
+        return format_duration(self.duration)
+
+    @classmethod
+    def from_list(cls, user_id, record):
+        """
+        Reads the [name, reason, bantime, bantime_string] lists the cog used to store in Config.
+        """
+        return cls(user_id, record[0], record[1], record[2], parse_duration_string(record[3]))
+
+    def __repr__(self):
+        return '<GlobalBan user_id={} name={!r} bantime={}>'.format(self.user_id, self.name, self.bantime)
@@ -0,0 +1,130 @@
+from datetime import datetime, time as dtime, timedelta
+import random
+
+from .records import parse_duration
+
+# The schedules synctime has always accepted, written as cron specs.
+NAMED_SCHEDULES = {'daily': '0 0 * * *', 'weekly': '0 0 * * 1', 'monthly': '0 0 1 * *'}
+
+# (lowest, highest) value of every cron field: minute, hour, day of the month, month and day of the week.
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def parse_field(text, low, high):
+    """
+    Reads one field of a cron spec, like *, */15, 1-5 or 1,15.
+
+    Input: The field and its lowest and highest value
+    Output: Set of the values it matches
+    """
+    values = set()
+    for part in text.split(','):
+        part, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if part == '*':
+            first, last = low, high
+        elif '-' in part:
+            first, last = (int(value) for value in part.split('-', 1))
+        else:
+            first = last = int(part)
+        if first < low or last > high or first > last or step < 1:
+            raise ValueError(text)
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class Schedule:
+    """
+    When the scheduled syncs run.
+
+    A schedule is daily, weekly or monthly, a cron spec like '0 3 * * 1' (minute, hour,
+    day of the month, month, day of the week) or an interval written like in globalban, e.g. 12H.
+    Cron specs use the bot's local time. Intervals are counted from the Unix epoch,
+    so every restart and every process agrees on when they run.
+
+    Usage: Schedule('weekly').next_run(time.time())
+    """
+
+    def __init__(self, spec):
+        """
+        Input: The schedule as text
+        Output: Nothing, raises ValueError if the schedule cannot be read
+        """
+        self.spec = spec
+        fields = NAMED_SCHEDULES.get(spec.lower(), spec).split()
+        self.interval = None
+        if len(fields) == 1:
+            self.interval, errors = parse_duration(fields[0])
+            if len(errors) > 0 or self.interval <= 0:
+                raise ValueError(spec)
+        elif len(fields) == 5:
+            self.minutes, self.hours, self.days, self.months, self.weekdays = (
+                parse_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS)
+            )
+            if 7 in self.weekdays:
+                self.weekdays.add(0)
+            self.any_day = fields[2] == '*'
+            self.any_weekday = fields[4] == '*'
+            self.next_run(0)
+        else:
+            raise ValueError(spec)
+
+    def matches_day(self, day):
+        """
+        Checks a day against the day, month and weekday fields. Like cron, when both the day
+        of the month and the day of the week are given, a day matching either one counts.
+        """
+        if day.month not in self.months:
+            return False
+        weekday = (day.weekday() + 1) % 7
+        if self.any_day or self.any_weekday:
+            return day.day in self.days and weekday in self.weekdays
+        return day.day in self.days or weekday in self.weekdays
+
+    def next_run(self, after):
+        """
+        Input: Unix time
+        Output: The first Unix time after it that the schedule runs at
+        """
+        if self.interval is not None:
+            return (after // self.interval + 1) * self.interval
+        start = datetime.fromtimestamp(max(after, 0)).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.date()
+        # Every cron spec that can run at all runs within 8 years (the 29th of February around a year like 2100).
+        for _ in range(8 * 366):
+            if self.matches_day(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        run = datetime.combine(day, dtime(hour, minute))
+                        if run >= start:
+                            return run.timestamp()
+            day += timedelta(days=1)
+        raise ValueError(self.spec)
+
+    def first_end(self, now):
+        """
+        Gives the end of the first period of a new schedule, which starts straight away.
+        When the schedule runs again very soon, that run is left out so the servers are not squeezed together.
+
+        Input: Unix time the period starts at
+        Output: Unix time the period ends at
+        """
+        end = self.next_run(now)
+        if end - now < (self.next_run(end) - end) / 2:
+            end = self.next_run(end)
+        return end
+
+    @staticmethod
+    def spread(servers, start, end):
+        """
+        Gives every server its own time between start and end, so their syncs are spread
+        evenly instead of all running at once. The period is cut into one slot per server
+        and every server runs at a random time inside its slot.
+
+        Input: List of server IDs, and the start and end of the period
+        Output: Dictionary of server ID -> Unix time to sync it at
+        """
+        servers = list(servers)
+        random.shuffle(servers)
+        slot = (end - start) / max(len(servers), 1)
+        return {server: start + (number + random.random()) * slot for number, server in enumerate(servers)}
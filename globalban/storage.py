@@ -0,0 +1,464 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import time
+
+from .records import GlobalBan
+
+
+class BanStore:
+    """
+    Where the global bans are kept.
+
+    Every ban is stored as a GlobalBan. Each write gets a new revision
+    so syncs can push only what changed.
+    """
+
+    async def all(self):
+        """
+        Output: Dictionary of user ID -> GlobalBan
+        """
+        raise NotImplementedError
+
+    async def count(self):
+        """
+        Output: Number of global bans
+        """
+        raise NotImplementedError
+
+    async def revision(self):
+        """
+        Output: The latest revision
+        """
+        raise NotImplementedError
+
+    async def added_since(self, revision):
+        """
+        Input: A revision
+        Output: Set of IDs banned after that revision
+        """
+        raise NotImplementedError
+
+    async def upsert_many(self, bans):
+        """
+        Adds or replaces many bans under one revision.
+
+        Input: List of GlobalBan
+        Output: The bans' revision
+        """
+        raise NotImplementedError
+
+    async def delete(self, *user_ids):
+        """
+        Removes bans.
+
+        Input: User IDs
+        Output: Nothing
+        """
+        raise NotImplementedError
+
+    async def dump(self):
+        """
+        Output: (list of (GlobalBan, revision), latest revision)
+        """
+        raise NotImplementedError
+
+    async def restore(self, rows, revision):
+        """
+        Loads the output of dump, keeping the revisions.
+
+        Input: List of (GlobalBan, revision) and the latest revision
+        Output: Nothing
+        """
+        raise NotImplementedError
+
+    async def changes_since(self, revision):
+        """
+        Gives what other processes sharing the store changed.
+
+        Input: The last revision this process has seen
+        Output: Dictionary of user ID -> GlobalBan, or None if the ban was removed
+        """
+        raise NotImplementedError
+
+    async def enqueue(self, action, user_id, guild_ids):
+        """
+        Saves that a user has to be banned or unbanned on some servers.
+        A newer action for the same user and server replaces the older one.
+
+        Input: 'ban' or 'unban', user ID and server IDs
+        Output: Nothing
+        """
+        raise NotImplementedError
+
+    async def enqueue_many(self, action, user_ids, guild_ids):
+        """
+        Saves that many users have to be banned or unbanned on some servers, in one write.
+
+        Input: 'ban' or 'unban', user IDs and server IDs
+        Output: Nothing
+        """
+        raise NotImplementedError
+
+    async def due(self, now, limit, shards=None):
+        """
+        Input: The current time, how many entries to give at most and optionally
+               (shard count, shard IDs) to only give entries of servers on those shards
+        Output: List of (server ID, user ID, action, attempts) whose next attempt is due
+        """
+        raise NotImplementedError
+
+    async def next_due(self, shards=None):
+        """
+        Input: Optionally (shard count, shard IDs) to only look at servers on those shards
+        Output: The time the next outbox entry is due, or None if the outbox is empty
+        """
+        raise NotImplementedError
+
+    async def complete(self, entries):
+        """
+        Removes outbox entries that are done, unless a newer action replaced them.
+
+        Input: List of (server ID, user ID, action)
+        Output: Nothing
+        """
+        raise NotImplementedError
+
+    async def retry(self, entries):
+        """
+        Puts outbox entries back for another attempt.
+
+        Input: List of (server ID, user ID, action, attempts, next attempt time)
+        Output: Nothing
+        """
+        raise NotImplementedError
+
+    async def replace(self, rows, revision):
+        """
+        Makes the store hold exactly the bans of a dump, removing every other ban.
+
+        Input: List of (GlobalBan, revision) and the latest revision
+        Output: Nothing
+        """
+        raise NotImplementedError
+
+    async def merge(self, bans):
+        """
+        Adds the bans the store does not have yet, leaving the ones it has alone.
+
+        Input: GlobalBans
+        Output: How many bans were added
+        """
+        raise NotImplementedError
+
+    async def outbox(self):
+        """
+        Output: List of every outbox entry as (server ID, user ID, action, attempts, next attempt time)
+        """
+        raise NotImplementedError
+
+    async def restore_outbox(self, entries):
+        """
+        Adds outbox entries, keeping the ones already there for the same user and server.
+
+        Input: List of (server ID, user ID, action, attempts, next attempt time)
+        Output: Nothing
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ConfigBanStore:
+    """
+    Reads the bans the cog used to keep in Red's Config, so migrate can copy them into SQLite.
+    It only reads, so it is not a BanStore.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    async def dump(self):
+        """
+        Output: (list of (GlobalBan, revision), latest revision)
+        """
+        global_bans = await self.config.global_bans() or {}
+        ban_revisions = await self.config.ban_revisions()
+        rows = [(GlobalBan.from_list(id, record), ban_revisions.get(id, 0)) for id, record in global_bans.items()]
+        return rows, await self.config.ban_revision()
+
+
+class SQLiteBanStore(BanStore):
+    """
+    Keeps the bans in an SQLite file, one row per ban.
+
+    user_id is the primary key and bantime and revision are indexed, so adding,
+    removing or looking up one ban costs O(log n) no matter how many bans there are.
+    Queries run on a single worker thread so they never block the bot.
+
+    Several bot processes can share one file. Every change is logged in the
+    changes table so the other processes can pick it up with changes_since.
+    """
+
+    # How many seconds entries are kept in the changes table.
+    CHANGES_KEPT = 24 * 60 * 60
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS bans (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            bantime REAL NOT NULL,
+            duration REAL,
+            revision INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS bans_bantime ON bans (bantime);
+        CREATE INDEX IF NOT EXISTS bans_revision ON bans (revision);
+        CREATE TABLE IF NOT EXISTS outbox (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_attempt REAL NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt);
+        CREATE TABLE IF NOT EXISTS changes (
+            revision INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            changed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS changes_revision ON changes (revision);
+        CREATE INDEX IF NOT EXISTS changes_changed ON changes (changed);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0);
+    """
+
+    def __init__(self, path):
+        """
+        Input: Path of the SQLite file
+        Output: Nothing
+        """
+        self.path = str(path)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(self.SCHEMA)
+        self._db.commit()
+
+    async def _run(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+
+    async def _fetch(self, query, *params):
+        return await self._run(lambda: self._db.execute(query, params).fetchall())
+
+    async def all(self):
+        rows = await self._fetch('SELECT user_id, name, reason, bantime, duration FROM bans')
+        return {row[0]: GlobalBan(*row) for row in rows}
+
+    async def count(self):
+        return (await self._fetch('SELECT COUNT(*) FROM bans'))[0][0]
+
+    async def revision(self):
+        return (await self._fetch("SELECT value FROM meta WHERE key = 'revision'"))[0][0]
+
+    async def added_since(self, revision):
+        return {row[0] for row in await self._fetch('SELECT user_id FROM bans WHERE revision > ?', revision)}
+
+    def _log_changes(self, user_ids):
+        """
+        Gives the changed bans a new revision in the changes table. Must be called inside a transaction.
+        """
+        now = time.time()
+        self._db.execute("UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+        revision = self._db.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+        self._db.executemany('INSERT INTO changes (revision, user_id, changed) VALUES (?, ?, ?)', [(revision, int(id), now) for id in user_ids])
+        self._db.execute('DELETE FROM changes WHERE changed < ?', (now - self.CHANGES_KEPT,))
+        return revision
+
+    def _upsert_many(self, bans):
+        with self._db:
+            revision = self._log_changes([ban.user_id for ban in bans])
+            self._db.executemany(
+                'INSERT OR REPLACE INTO bans (user_id, name, reason, bantime, duration, revision) VALUES (?, ?, ?, ?, ?, ?)',
+                [(ban.user_id, ban.name, ban.reason, ban.bantime, ban.duration, revision) for ban in bans]
+            )
+        return revision
+
+    async def upsert_many(self, bans):
+        return await self._run(self._upsert_many, list(bans))
+
+    def _delete(self, user_ids):
+        with self._db:
+            self._log_changes(user_ids)
+            self._db.executemany('DELETE FROM bans WHERE user_id = ?', [(int(id),) for id in user_ids])
+
+    async def delete(self, *user_ids):
+        await self._run(self._delete, user_ids)
+
+    async def dump(self):
+        rows = await self._fetch('SELECT user_id, name, reason, bantime, duration, revision FROM bans')
+        return [(GlobalBan(*row[:5]), row[5]) for row in rows], await self.revision()
+
+    def _restore(self, rows, revision):
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO bans (user_id, name, reason, bantime, duration, revision) VALUES (?, ?, ?, ?, ?, ?)',
+                [(ban.user_id, ban.name, ban.reason, ban.bantime, ban.duration, rev) for ban, rev in rows]
+            )
+            self._db.execute("UPDATE meta SET value = MAX(value, ?) WHERE key = 'revision'", (revision,))
+
+    async def restore(self, rows, revision):
+        await self._run(self._restore, rows, revision)
+
+    async def changes_since(self, revision):
+        rows = await self._fetch(
+            'SELECT DISTINCT changes.user_id, bans.name, bans.reason, bans.bantime, bans.duration FROM changes '
+            'LEFT JOIN bans ON bans.user_id = changes.user_id WHERE changes.revision > ?',
+            revision
+        )
+        return {row[0]: None if row[1] is None else GlobalBan(*row) for row in rows}
+
+    def _enqueue(self, action, user_ids, guild_ids):
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO outbox (guild_id, user_id, action, attempts, next_attempt) VALUES (?, ?, ?, 0, ?)',
+                ((guild_id, int(user_id), action, now) for user_id in user_ids for guild_id in guild_ids)
+            )
+
+    async def enqueue(self, action, user_id, guild_ids):
+        await self._run(self._enqueue, action, [user_id], list(guild_ids))
+
+    async def enqueue_many(self, action, user_ids, guild_ids):
+        await self._run(self._enqueue, action, list(user_ids), list(guild_ids))
+
+    @staticmethod
+    def _shard_filter(shards):
+        """
+        Builds the part of a WHERE clause that keeps only the servers on some shards.
+        A server's shard is (server ID >> 22) % shard count.
+        """
+        if shards is None:
+            return '', ()
+        shard_count, shard_ids = shards
+        placeholders = ', '.join('?' for id in shard_ids)
+        return ' AND ((guild_id >> 22) % ?) IN ({})'.format(placeholders), (shard_count, *shard_ids)
+
+    async def due(self, now, limit, shards=None):
+        where, params = self._shard_filter(shards)
+        rows = await self._fetch(
+            'SELECT guild_id, user_id, action, attempts FROM outbox WHERE next_attempt <= ?{} ORDER BY next_attempt LIMIT ?'.format(where),
+            now, *params, limit
+        )
+        return [tuple(row) for row in rows]
+
+    async def next_due(self, shards=None):
+        where, params = self._shard_filter(shards)
+        return (await self._fetch('SELECT MIN(next_attempt) FROM outbox WHERE 1{}'.format(where), *params))[0][0]
+
+    def _complete(self, entries):
+        with self._db:
+            self._db.executemany('DELETE FROM outbox WHERE guild_id = ? AND user_id = ? AND action = ?', entries)
+
+    async def complete(self, entries):
+        await self._run(self._complete, list(entries))
+
+    def _retry(self, entries):
+        with self._db:
+            self._db.executemany(
+                'UPDATE outbox SET attempts = ?, next_attempt = ? WHERE guild_id = ? AND user_id = ? AND action = ?',
+                [(attempts, next_attempt, guild_id, user_id, action) for guild_id, user_id, action, attempts, next_attempt in entries]
+            )
+
+    async def retry(self, entries):
+        await self._run(self._retry, list(entries))
+
+    def _replace(self, rows, revision):
+        with self._db:
+            user_ids = [ban.user_id for ban, rev in rows]
+            self._db.execute('DELETE FROM bans')
+            self._db.executemany(
+                'INSERT INTO bans (user_id, name, reason, bantime, duration, revision) VALUES (?, ?, ?, ?, ?, ?)',
+                [(ban.user_id, ban.name, ban.reason, ban.bantime, ban.duration, rev) for ban, rev in rows]
+            )
+            self._db.execute("UPDATE meta SET value = MAX(value, ?) WHERE key = 'revision'", (revision,))
+            self._log_changes(user_ids)
+
+    async def replace(self, rows, revision):
+        await self._run(self._replace, rows, revision)
+
+    def _merge(self, bans):
+        with self._db:
+            existing = {row[0] for row in self._db.execute('SELECT user_id FROM bans')}
+            missing = [ban for ban in bans if ban.user_id not in existing]
+            if len(missing) > 0:
+                revision = self._log_changes([ban.user_id for ban in missing])
+                self._db.executemany(
+                    'INSERT INTO bans (user_id, name, reason, bantime, duration, revision) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(ban.user_id, ban.name, ban.reason, ban.bantime, ban.duration, revision) for ban in missing]
+                )
+        return len(missing)
+
+    async def merge(self, bans):
+        return await self._run(self._merge, list(bans))
+
+    async def outbox(self):
+        rows = await self._fetch('SELECT guild_id, user_id, action, attempts, next_attempt FROM outbox')
+        return [tuple(row) for row in rows]
+
+    def _restore_outbox(self, entries):
+        with self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO outbox (guild_id, user_id, action, attempts, next_attempt) VALUES (?, ?, ?, ?, ?)', entries
+            )
+
+    async def restore_outbox(self, entries):
+        await self._run(self._restore_outbox, list(entries))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+
+async def move_store(source, target, replace=False):
+    """
+    Moves everything a store holds into another one, when the cog switches to it.
+
+    The bans are copied over when replace is True or the target has none yet. Otherwise
+    the target's own bans are kept and only the bans it is missing are added. The outbox
+    entries that are still waiting are always moved, so no ban or unban is lost on the way.
+
+    Input: The store to move from, the store to move into and whether to replace the target's bans
+    Output: (how many bans were copied, how many outbox entries were moved)
+    """
+    rows, revision = await source.dump()
+    if replace or await target.count() == 0:
+        await target.replace(rows, revision)
+        copied = len(rows)
+    else:
+        copied = await target.merge(ban for ban, rev in rows)
+    entries = await source.outbox()
+    await target.restore_outbox(entries)
+    await source.complete([(guild_id, user_id, action) for guild_id, user_id, action, attempts, next_attempt in entries])
+    return copied, len(entries)
+
+
+async def migrate(source, target):
+    """
+    Copies every ban from an old store, like ConfigBanStore, into another, keeping their revisions.
+    Nothing is copied if the target already has bans.
+
+    Input: The store to copy from and the store to copy into
+    Output: How many bans were copied
+    """
+    if await target.count() > 0:
+        return 0
+    rows, revision = await source.dump()
+    if len(rows) > 0:
+        await target.restore(rows, revision)
+    return len(rows)
@@ -0,0 +1,106 @@
+import csv
+import json
+import math
+import re
+import time
+
+from .records import FOREVER_BANTIME, GlobalBan
+
+# The fields of every exported ban, in the order of the CSV columns.
+FIELDS = ('user_id', 'name', 'reason', 'bantime', 'duration')
+FORMATS = ('jsonl', 'csv')
+
+
+def write_bans(bans, file, format):
+    """
+    Writes bans to a file one line at a time, as JSON lines or CSV with a header.
+    A ban that lasts forever has an empty duration.
+
+    Input: GlobalBans, an open text file and 'jsonl' or 'csv'
+    Output: How many bans were written
+    """
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(FIELDS)
+    for ban in bans:
+        if format == 'csv':
+            writer.writerow([ban.user_id, ban.name, ban.reason, ban.bantime, '' if ban.duration is None else ban.duration])
+        else:
+            file.write(json.dumps({field: getattr(ban, field) for field in FIELDS}) + '\n')
+        count += 1
+    return count
+
+
+def parse_ban(record, now):
+    """
+    Checks one imported record and turns it into a GlobalBan.
+
+    Only user_id and name are needed. The reason defaults to 'Not Given', a missing
+    duration means forever and a missing bantime is worked out from the duration.
+
+    Input: Dictionary with the FIELDS and the current time
+    Output: GlobalBan, raises ValueError saying what is wrong with the record
+    """
+    user_id = record.get('user_id')
+    if isinstance(user_id, str) and re.fullmatch('[0-9]+', user_id.strip()):
+        user_id = int(user_id)
+    elif not isinstance(user_id, int) or isinstance(user_id, bool):
+        raise ValueError('user_id must be a whole number')
+    if not 0 < user_id < 2 ** 64:
+        raise ValueError('user_id is not a Discord ID')
+    name = record.get('name')
+    if not isinstance(name, str) or len(name) == 0:
+        raise ValueError('name is missing')
+    reason = record.get('reason') or 'Not Given'
+    try:
+        duration = record.get('duration')
+        duration = None if duration in (None, '') else float(duration)
+        bantime = record.get('bantime')
+        bantime = None if bantime in (None, '') else float(bantime)
+    except (TypeError, ValueError):
+        raise ValueError('bantime and duration must be numbers')
+    if not all(value is None or math.isfinite(value) for value in (duration, bantime)):
+        raise ValueError('bantime and duration must be finite numbers')
+    if duration is None:
+        return GlobalBan(user_id, name, str(reason), FOREVER_BANTIME, None)
+    if duration <= 0:
+        raise ValueError('duration must be more than 0')
+    if bantime is None:
+        bantime = now + duration
+    if bantime <= now:
+        raise ValueError('the ban has already ended')
+    return GlobalBan(user_id, name, str(reason), bantime, duration)
+
+
+def read_bans(file, format):
+    """
+    Reads bans written by write_bans, or by another bot in the same format, one line at a time.
+
+    Input: An open text file and 'jsonl' or 'csv'
+    Output: Yields (line number, GlobalBan, None) for every good record and (line number, None, error) for every bad one
+    """
+    now = time.time()
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        if reader.fieldnames is None or not {'user_id', 'name'} <= set(reader.fieldnames):
+            yield 1, None, 'the header needs at least user_id and name'
+            return
+        for record in reader:
+            try:
+                yield reader.line_num, parse_ban(record, now), None
+            except ValueError as ex:
+                yield reader.line_num, None, str(ex)
+        return
+    for number, line in enumerate(file, start=1):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('the line is not a JSON object')
+            yield number, parse_ban(record, now), None
+        except json.JSONDecodeError:
+            yield number, None, 'the line is not valid JSON'
+        except ValueError as ex:
+            yield number, None, str(ex)
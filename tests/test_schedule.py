@@ -0,0 +1,77 @@
+"""
+Tests for the schedules synctime accepts.
+
+Usage: python -m unittest discover tests
+"""
+from datetime import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from globalban.schedule import Schedule  # noqa: E402
+
+
+def at(*args):
+    """
+    Gives the Unix time of a local date and time, like cron specs use.
+    """
+    return datetime(*args).timestamp()
+
+
+class NextRunTest(unittest.TestCase):
+
+    def test_named_schedules(self):
+        # 2024-01-01 is a Monday.
+        self.assertEqual(Schedule('daily').next_run(at(2024, 1, 1, 10, 0)), at(2024, 1, 2, 0, 0))
+        self.assertEqual(Schedule('Weekly').next_run(at(2024, 1, 1, 10, 0)), at(2024, 1, 8, 0, 0))
+        self.assertEqual(Schedule('monthly').next_run(at(2024, 1, 15, 10, 0)), at(2024, 2, 1, 0, 0))
+
+    def test_next_run_is_after_the_time_given(self):
+        self.assertEqual(Schedule('daily').next_run(at(2024, 1, 2, 0, 0)), at(2024, 1, 3, 0, 0))
+
+    def test_cron_spec(self):
+        schedule = Schedule('*/15 3 * * *')
+        self.assertEqual(schedule.next_run(at(2024, 1, 1, 3, 20)), at(2024, 1, 1, 3, 30))
+        self.assertEqual(schedule.next_run(at(2024, 1, 1, 3, 45)), at(2024, 1, 2, 3, 0))
+
+    def test_day_of_month_or_day_of_week(self):
+        # The 13th or any Monday. 2024-09-09 is a Monday and 2024-09-13 a Friday.
+        schedule = Schedule('0 0 13 * 1')
+        self.assertEqual(schedule.next_run(at(2024, 9, 9, 0, 0)), at(2024, 9, 13, 0, 0))
+        self.assertEqual(schedule.next_run(at(2024, 9, 13, 0, 0)), at(2024, 9, 16, 0, 0))
+
+    def test_only_one_day_field_given(self):
+        self.assertEqual(Schedule('0 0 13 * *').next_run(at(2024, 9, 9, 0, 0)), at(2024, 9, 13, 0, 0))
+        self.assertEqual(Schedule('0 0 * * 5').next_run(at(2024, 9, 9, 0, 0)), at(2024, 9, 13, 0, 0))
+
+    def test_sunday_is_0_and_7(self):
+        self.assertEqual(Schedule('0 0 * * 7').next_run(at(2024, 1, 1, 0, 0)), at(2024, 1, 7, 0, 0))
+        self.assertEqual(Schedule('0 0 * * 0').next_run(at(2024, 1, 1, 0, 0)), at(2024, 1, 7, 0, 0))
+
+    def test_29th_of_february(self):
+        self.assertEqual(Schedule('0 0 29 2 *').next_run(at(2024, 3, 1, 0, 0)), at(2028, 2, 29, 0, 0))
+
+    def test_interval(self):
+        schedule = Schedule('12H')
+        self.assertEqual(schedule.next_run(0), 12 * 60 * 60)
+        self.assertEqual(schedule.next_run(12 * 60 * 60), 24 * 60 * 60)
+
+    def test_first_end_skips_a_run_that_is_too_close(self):
+        schedule = Schedule('12H')
+        self.assertEqual(schedule.first_end(12 * 60 * 60 - 100), 24 * 60 * 60)
+        self.assertEqual(schedule.first_end(60), 12 * 60 * 60)
+
+
+class RejectedSpecTest(unittest.TestCase):
+
+    def test_rejected_specs(self):
+        for spec in ('hourly', '0 0 * *', '60 * * * *', '* 24 * * *', '5-1 * * * *', '*/0 * * * *', '0 0 31 2 *', '0H', 'a b c d e'):
+            with self.subTest(spec=spec):
+                with self.assertRaises(ValueError):
+                    Schedule(spec)
+
+
+if __name__ == '__main__':
+    unittest.main()